@@ -0,0 +1,346 @@
+#!/usr/bin/env python
+"""
+This step scores the current prod model and a set of candidate models on the test split, and moves the
+"prod" alias to the best candidate if it beats the current one by a configurable margin.
+"""
+import argparse
+import logging
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import mlflow
+import numpy as np
+import pandas as pd
+import wandb
+from wandb_utils.chunked_artifact import download_dir
+from wandb_utils.evaluation import evaluate
+from wandb_utils.splits import use_split
+
+# Setup logging
+logging.basicConfig(level=logging.INFO, format="%(asctime)-15s %(message)s")
+logger = logging.getLogger()
+
+# Test set of a worker process, attached once when the worker starts rather than sent with every model, and
+# the shared memory blocks it is read from
+_X_test = None
+_test_set_shms = []
+
+
+def _share_array(array, shms):
+    shm = shared_memory.SharedMemory(create=True, size=max(1, array.nbytes))
+    shms.append(shm)
+    np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[...] = array
+    return {"name": shm.name, "shape": array.shape, "dtype": array.dtype.str}
+
+
+def _attach_array(spec, shms):
+    shm = shared_memory.SharedMemory(name=spec["name"])
+    shms.append(shm)
+    return np.ndarray(spec["shape"], dtype=np.dtype(spec["dtype"]), buffer=shm.buf)
+
+
+def _share_frame(df, shms):
+    """
+    Copy the columns of a DataFrame into shared memory and return their description: numpy columns as they
+    are, nullable integers as values and mask, categoricals as codes (the categories travel with the
+    description) and strings as their concatenated UTF-8 bytes and offsets
+    """
+    columns = []
+    for c in df.columns:
+        column = df[c]
+        if isinstance(column.dtype, pd.CategoricalDtype):
+            spec = {
+                "kind": "category",
+                "categories": column.cat.categories.tolist(),
+                "codes": _share_array(column.cat.codes.to_numpy(), shms),
+            }
+        elif pd.api.types.is_integer_dtype(column.dtype) and isinstance(column.dtype, pd.api.extensions.ExtensionDtype):
+            spec = {
+                "kind": "nullable",
+                "values": _share_array(column.fillna(0).to_numpy(dtype=column.dtype.numpy_dtype), shms),
+                "mask": _share_array(column.isna().to_numpy(), shms),
+            }
+        elif isinstance(column.dtype, np.dtype) and column.dtype != object:
+            spec = {"kind": "numpy", "values": _share_array(column.to_numpy(), shms)}
+        else:
+            values = column.to_numpy(dtype=object)
+            missing = pd.isna(values)
+            encoded = [b"" if m else v.encode() for v, m in zip(values, missing)]
+            spec = {
+                "kind": "string",
+                "data": _share_array(np.frombuffer(b"".join(encoded) or b"\0", dtype=np.uint8), shms),
+                "offsets": _share_array(np.cumsum([0] + [len(e) for e in encoded], dtype=np.int64), shms),
+                "missing": _share_array(missing, shms),
+            }
+        columns.append((c, spec))
+    return columns
+
+
+def _attach_frame(columns, shms):
+    """
+    Rebuild a DataFrame described by _share_frame. The numeric columns are views on the shared blocks, the
+    string columns are decoded into Python objects, which cannot live in shared memory
+    """
+    frame = {}
+    for c, spec in columns:
+        if spec["kind"] == "category":
+            dtype = pd.CategoricalDtype(spec["categories"])
+            frame[c] = pd.Categorical.from_codes(_attach_array(spec["codes"], shms), dtype=dtype)
+        elif spec["kind"] == "nullable":
+            frame[c] = pd.arrays.IntegerArray(_attach_array(spec["values"], shms), _attach_array(spec["mask"], shms))
+        elif spec["kind"] == "numpy":
+            frame[c] = _attach_array(spec["values"], shms)
+        else:
+            data = _attach_array(spec["data"], shms).tobytes()
+            offsets = _attach_array(spec["offsets"], shms)
+            missing = _attach_array(spec["missing"], shms)
+            values = np.full(missing.shape[0], np.nan, dtype=object)
+            for i in np.flatnonzero(~missing):
+                values[i] = data[offsets[i]:offsets[i + 1]].decode()
+            frame[c] = values
+    return pd.DataFrame(frame, copy=False)
+
+
+def _set_test_set(columns):
+    global _X_test
+    _X_test = _attach_frame(columns, _test_set_shms)
+
+
+def _score_model(model_path, n_jobs, latency_rows, latency_repeats):
+    """
+    Load a model and score the shared test set with it, measuring the prediction latency
+
+    :return: (predictions, seconds per row for the whole batch, median seconds of a single-row prediction)
+    """
+    model = mlflow.sklearn.load_model(model_path)
+    model[-1].set_params(n_jobs=n_jobs)
+
+    start = time.perf_counter()
+    y_pred = model.predict(_X_test)
+    batch_seconds_per_row = (time.perf_counter() - start) / _X_test.shape[0]
+
+    # Single-row latency, as seen by an online caller
+    model[-1].set_params(n_jobs=1)
+    single_row = []
+    for i in range(min(latency_rows, _X_test.shape[0])):
+        row = _X_test.iloc[[i]]
+        for _ in range(latency_repeats):
+            start = time.perf_counter()
+            model.predict(row)
+            single_row.append(time.perf_counter() - start)
+
+    return y_pred, batch_seconds_per_row, float(np.median(single_row)) if single_row else np.nan
+
+
+def score_candidates(model_paths, X_test, n_parallel, latency_rows=20, latency_repeats=5):
+    """
+    Score several models on the same test set in parallel worker processes
+
+    :param model_paths: dictionary of local MLflow model paths, keyed by candidate name
+    :param X_test: test features DataFrame
+    :param n_parallel: number of models scored concurrently
+    :param latency_rows: number of test rows used to measure the single-row latency
+    :param latency_repeats: number of times each of those rows is predicted
+    :return: dictionary of (predictions, batch seconds per row, single-row seconds), keyed by candidate name
+    """
+    # All the candidates run concurrently with the same share of the cores, so their latencies are comparable
+    n_jobs = max(1, (os.cpu_count() or 1) // n_parallel)
+    shms = []
+    try:
+        # The test set is parsed once and shared: the workers only receive the names of the blocks
+        columns = _share_frame(X_test, shms)
+        # The workers are spawned, not forked: forking after wandb.init would copy the state of its threads
+        with ProcessPoolExecutor(
+            max_workers=n_parallel,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_set_test_set,
+            initargs=(columns,),
+        ) as executor:
+            futures = {
+                name: executor.submit(_score_model, path, n_jobs, latency_rows, latency_repeats)
+                for name, path in model_paths.items()
+            }
+            return {name: future.result() for name, future in futures.items()}
+    finally:
+        for shm in shms:
+            shm.close()
+            shm.unlink()
+
+
+def choose_winner(results, champion, metric, min_improvement, max_latency_ratio):
+    """
+    Pick the candidate that should become prod, if any
+
+    :param results: DataFrame of metrics indexed by candidate name
+    :param champion: name of the current prod model in results, or None if there is no prod model yet (the
+                     best candidate then wins)
+    :param metric: metric to compare (lower is better, e.g. mae or rmse)
+    :param min_improvement: minimum relative improvement of the metric over the champion
+    :param max_latency_ratio: maximum single-row latency of the candidate relative to the champion
+    :return: name of the winning candidate, or None to keep the champion
+    """
+    if champion is None:
+        return results[metric].idxmin() if results[metric].notna().any() else None
+    baseline = results.loc[champion]
+    eligible = results.drop(index=champion)
+    eligible = eligible[
+        (eligible[metric] <= baseline[metric] * (1 - min_improvement))
+        & (eligible["latency_single_row_ms"] <= baseline["latency_single_row_ms"] * max_latency_ratio)
+    ]
+    if eligible.empty:
+        return None
+    return eligible[metric].idxmin()
+
+
+def go(args):
+    """
+    Score the champion and the candidates and promote the winner.
+    """
+    run = wandb.init(job_type="promote_model")
+    run.config.update(vars(args))
+
+    logger.info("Downloading models")
+    artifacts = {}
+    try:
+        champion_artifact = run.use_artifact(args.champion)
+        artifacts[champion_artifact.name] = champion_artifact
+        champion = champion_artifact.name
+    except wandb.errors.CommError:
+        # First run of the pipeline: nothing has the alias yet, the best candidate gets it
+        logger.info(f"No model {args.champion} yet, the best candidate will be promoted")
+        champion = None
+    for name in [c.strip() for c in args.candidates.split(",") if c.strip()]:
+        artifact = run.use_artifact(name)
+        # The same version can be reached through several aliases (e.g. latest and prod)
+        if artifact.digest not in {a.digest for a in artifacts.values()}:
+            artifacts[artifact.name] = artifact
+    if not artifacts:
+        logger.info("No model to score, nothing to do")
+        run.finish()
+        return
+    if champion is not None and len(artifacts) == 1:
+        logger.info("No candidate different from the champion, nothing to do")
+        run.finish()
+        return
+    model_paths = {name: download_dir(artifact) for name, artifact in artifacts.items()}
+
+    logger.info("Loading test dataset")
+    test_df = use_split(run, args.test_dataset).materialize(run)
+    y_test = test_df.pop("price")
+
+    n_parallel = max(1, min(len(model_paths), args.n_parallel))
+    logger.info(f"Scoring {len(model_paths)} models, {n_parallel} at a time")
+    scores = score_candidates(model_paths, test_df, n_parallel)
+
+    rows = {}
+    for name, (y_pred, batch_seconds_per_row, single_row_seconds) in scores.items():
+        metrics, _ = evaluate(y_test, y_pred)
+        metrics["latency_batch_us_per_row"] = batch_seconds_per_row * 1e6
+        metrics["latency_single_row_ms"] = single_row_seconds * 1e3
+        rows[name] = metrics
+        logger.info(
+            f"{name}: MAE {metrics['mae']:.3f}, R2 {metrics['r2']:.3f}, "
+            f"{metrics['latency_single_row_ms']:.1f} ms per single-row prediction"
+        )
+    results = pd.DataFrame.from_dict(rows, orient="index")
+    run.log({"candidates": wandb.Table(dataframe=results.rename_axis("model").reset_index())})
+
+    winner = choose_winner(results, champion, args.metric, args.min_improvement, args.max_latency_ratio)
+    run.summary["champion"] = champion or "none"
+    run.summary["promoted"] = winner or "none"
+    if winner is None and champion is None:
+        logger.info("No candidate could be scored, nothing to promote")
+    elif winner is None:
+        logger.info(f"No candidate beats {champion} by {args.min_improvement:.1%} on {args.metric}, keeping it")
+    elif args.dry_run:
+        logger.info(f"{winner} would be promoted to {args.alias} (dry run)")
+    else:
+        logger.info(f"Promoting {winner} to {args.alias}")
+        # An alias is unique within the artifact collection, so this also removes it from the champion
+        artifacts[winner].aliases.append(args.alias)
+        artifacts[winner].save()
+
+    run.finish()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare candidate models with the prod model and promote the best")
+
+    parser.add_argument(
+        "--champion",
+        type=str,
+        help="Current model (e.g., 'random_forest_export:prod')",
+        default="random_forest_export:prod",
+        required=False,
+    )
+
+    parser.add_argument(
+        "--candidates",
+        type=str,
+        help="Comma-separated list of candidate models (e.g., 'random_forest_export:latest,random_forest_export:v5')",
+        required=True,
+    )
+
+    parser.add_argument(
+        "--test_dataset",
+        type=str,
+        help="Test split artifact (e.g., 'test_split:latest')",
+        default="test_split:latest",
+        required=False,
+    )
+
+    parser.add_argument(
+        "--metric",
+        type=str,
+        help="Metric to compare, lower is better",
+        default="mae",
+        choices=["mae", "rmse"],
+        required=False,
+    )
+
+    parser.add_argument(
+        "--min_improvement",
+        type=float,
+        help="Minimum relative improvement of the metric over the champion for a candidate to be promoted",
+        default=0.01,
+        required=False,
+    )
+
+    parser.add_argument(
+        "--max_latency_ratio",
+        type=float,
+        help="Maximum single-row latency of a promoted candidate, relative to the champion",
+        default=1.5,
+        required=False,
+    )
+
+    parser.add_argument(
+        "--n_parallel",
+        type=int,
+        help="Number of models scored concurrently",
+        default=4,
+        required=False,
+    )
+
+    parser.add_argument(
+        "--alias",
+        type=str,
+        help="Alias to move to the winning candidate",
+        default="prod",
+        required=False,
+    )
+
+    parser.add_argument(
+        "--dry_run",
+        type=lambda s: str(s).lower() == "true",
+        help="Only report the winner, without moving the alias",
+        default=False,
+        required=False,
+    )
+
+    args = parser.parse_args()
+
+    go(args)
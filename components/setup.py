@@ -13,6 +13,8 @@ setup(
     ],
     install_requires=[
         "mlflow",
-        "wandb"
+        "wandb",
+        "numpy",
+        "pandas"
     ]
 )
\ No newline at end of file
@@ -6,14 +6,29 @@ import argparse
 import logging
 import wandb
 import mlflow
-import pandas as pd
-from sklearn.metrics import mean_absolute_error, r2_score
+from wandb_utils.chunked_artifact import download_dir
+from wandb_utils.evaluation import SEGMENT_COLUMNS, evaluate, log_evaluation
+from wandb_utils.feature_store import FeatureStore, StoredFeaturesModel
+from wandb_utils.prediction_cache import PredictionCache
+from wandb_utils.sanitize_path import sanitize_path
+from wandb_utils.splits import use_split
 
 # Setup logging
 logging.basicConfig(level=logging.INFO, format="%(asctime)-15s %(message)s")
 logger = logging.getLogger()
 
 
+def uses_batch_reference(model):
+    """
+    Whether the model computes a feature relative to the batch it predicts (the delta_date_feature of models
+    exported before DateDeltaFeature), in which case its predictions cannot be cached per row
+    """
+    return any(
+        getattr(getattr(value, "func", None), "__name__", None) == "delta_date_feature"
+        for value in model.get_params(deep=True).values()
+    )
+
+
 def go(args):
     """
     Test the regression model and log metrics.
@@ -24,33 +39,54 @@ def go(args):
 
     logger.info("Downloading artifacts")
 
-    # Fetch the MLflow model artifact with the "prod" tag
-    model_local_path = run.use_artifact("random_forest_export:prod").download()
+    # Fetch the MLflow model artifact (by default the one with the "prod" tag)
+    model_artifact = run.use_artifact(args.mlflow_model)
+    model_local_path = download_dir(model_artifact)
 
-    # Fetch the test dataset artifact
-    test_dataset_path = run.use_artifact("test_data.csv:latest").file()
+    # Load the model
+    logger.info("Loading model")
+    model = mlflow.sklearn.load_model(model_local_path)
+    batch_reference = uses_batch_reference(model)
 
-    # Load the test dataset
+    # Fetch the test split and load its rows from the dataset it points into, parsing only the columns the
+    # model reads, the target and the segments
     logger.info("Loading test dataset")
-    test_df = pd.read_csv(test_dataset_path)
+    # Models trained with the feature store read the features of the listings from it, by id
+    use_store = args.feature_store_dir != "none" and "features" in model.named_steps
+    columns = list(dict.fromkeys(list(model.feature_names_in_) + ["price"] + SEGMENT_COLUMNS))
+    if use_store:
+        columns.append("id")
+    test_df = use_split(run, args.test_dataset).materialize(run, usecols=columns)
     y_test = test_df.pop("price")
     X_test = test_df
 
-    # Load the model
-    logger.info("Loading model and performing inference on test set")
-    model = mlflow.sklearn.load_model(model_local_path)
-    y_pred = model.predict(X_test)
-
-    # Calculate metrics
+    if use_store:
+        store = FeatureStore(sanitize_path(args.feature_store_dir), model["features"])
+        run.summary["feature_store_computed"] = store.update(X_test)
+        model = StoredFeaturesModel(model, store)
+
+    logger.info("Performing inference on test set")
+
+    # Rows already scored by this same model version (e.g. in a previous nightly run) come from the cache
+    cache_dir = sanitize_path(args.prediction_cache_dir) if args.prediction_cache_dir != "none" else None
+    if cache_dir is not None and batch_reference:
+        # The in-memory tier starts empty, so the whole test set is predicted in a single batch
+        logger.info("The model has batch-dependent features, its predictions are not cached on disk")
+        cache_dir = None
+    cache = PredictionCache(model_version=model_artifact.digest, cache_dir=cache_dir)
+    y_pred = cache.predict(model, X_test)
+    cache.close()
+    run.summary["prediction_cache_hit_rate"] = cache.hit_rate
+    run.summary.update({f"prediction_cache_{k}": v for k, v in cache.stats.items()})
+
+    # Calculate metrics, globally and per segment
     logger.info("Calculating metrics")
-    mae = mean_absolute_error(y_test, y_pred)
-    r2 = r2_score(y_test, y_pred)
+    metrics, segment_metrics = evaluate(y_test, y_pred, X_test[SEGMENT_COLUMNS])
 
     # Log metrics to WandB
-    logger.info(f"MAE: {mae}")
-    logger.info(f"R2: {r2}")
-    run.summary["mae"] = mae
-    run.summary["r2"] = r2
+    logger.info(f"MAE: {metrics['mae']}")
+    logger.info(f"R2: {metrics['r2']}")
+    log_evaluation(run, metrics, segment_metrics)
 
     logger.info("Testing completed successfully")
 
@@ -70,8 +106,24 @@ if __name__ == "__main__":
     parser.add_argument(
         "--test_dataset",
         type=str,
-        help="Test dataset artifact (e.g., 'test_data.csv:latest')",
-        default="test_data.csv:latest",  # Defaulting to latest test dataset
+        help="Test split artifact (e.g., 'test_split:latest')",
+        default="test_split:latest",  # Defaulting to latest test split
+        required=False,
+    )
+
+    parser.add_argument(
+        "--prediction_cache_dir",
+        type=str,
+        help="Directory of the on-disk prediction cache ('none' to only use the in-memory cache)",
+        default="none",
+        required=False,
+    )
+
+    parser.add_argument(
+        "--feature_store_dir",
+        type=str,
+        help="Directory of the listing feature store ('none' to compute the features in the model)",
+        default="none",
         required=False,
     )
 
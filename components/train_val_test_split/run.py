@@ -5,11 +5,11 @@ This script splits the provided dataframe into train-validation and test sets.
 
 import argparse
 import logging
-import pandas as pd
+import numpy as np
 import wandb
-import tempfile
 from sklearn.model_selection import train_test_split
-from wandb_utils import log_artifact  # Importing the log_artifact utility function
+from wandb_utils.partitions import dataset_digest, dataset_path, read_dataset
+from wandb_utils.splits import SplitIndex, log_split
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)-15s %(message)s")
 logger = logging.getLogger()
@@ -24,34 +24,35 @@ def go(args):
 
     # Fetch the input artifact
     logger.info(f"Fetching artifact {args.input}")
-    artifact_local_path = run.use_artifact(args.input).file()
+    artifact = run.use_artifact(args.input)
+    artifact_local_path = dataset_path(artifact)
 
-    # Load the dataset
+    # Only the stratification column is needed to compute the split, the rows themselves are not copied
     logger.info("Loading dataset")
-    df = pd.read_csv(artifact_local_path)
+    stratify_col = args.stratify_by if args.stratify_by != "none" else None
+    df = read_dataset(artifact_local_path, usecols=[stratify_col] if stratify_col else ["id"])
 
-    # Perform train-validation and test split
+    # Perform train-validation and test split on the row positions
     logger.info("Splitting dataset into train-validation and test sets")
-    trainval, test = train_test_split(
-        df,
+    trainval_idx, test_idx = train_test_split(
+        np.arange(df.shape[0]),
         test_size=args.test_size,
         random_state=args.random_seed,
-        stratify=df[args.stratify_by] if args.stratify_by != "none" else None,
+        stratify=df[stratify_col] if stratify_col else None,
     )
 
-    # Save and log the splits
-    for split, name in zip([trainval, test], ["trainval", "test"]):
-        logger.info(f"Uploading {name}_data.csv")
-        with tempfile.NamedTemporaryFile("w", delete=False) as fp:
-            split.to_csv(fp.name, index=False)
-            log_artifact(
-                name=f"{name}_data.csv",
-                type=f"{name}_data",
-                description=f"{name} split of the dataset",
-                path=fp.name,
-                run=run,
-                aliases=["latest", "reference"] if name == "trainval" else ["latest"],
-            )
+    # Log the splits as row-index artifacts pointing into the input artifact
+    source_digest = dataset_digest(artifact_local_path)
+    for idx, name in zip([trainval_idx, test_idx], ["trainval", "test"]):
+        logger.info(f"Uploading {name}_split ({idx.shape[0]} rows)")
+        log_split(
+            SplitIndex(idx, artifact.name, source_digest),
+            artifact_name=f"{name}_split",
+            artifact_type="split_index",
+            artifact_description=f"{name} split of {artifact.name} (row index)",
+            wandb_run=run,
+            aliases=["latest", "reference"] if name == "trainval" else ["latest"],
+        )
 
 
 if __name__ == "__main__":
@@ -0,0 +1,319 @@
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import time
+import zlib
+
+import numpy as np
+import wandb
+
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_NAME = "chunk_manifest.json"
+CHUNKS_DIR = "chunks"
+DEFAULT_CACHE_DIR = os.environ.get(
+    "WANDB_UTILS_CHUNK_CACHE", os.path.join(os.path.expanduser("~"), ".cache", "wandb_utils", "chunks")
+)
+# The chunk cache is pruned (least recently used chunks first) down to this size, and chunks unused for this
+# many days are removed. Chunks missing from the cache are simply staged again by the next upload
+CACHE_MAX_BYTES = int(float(os.environ.get("WANDB_UTILS_CHUNK_CACHE_MAX_GB", "10")) * 1e9)
+CACHE_MAX_AGE_DAYS = float(os.environ.get("WANDB_UTILS_CHUNK_CACHE_MAX_AGE_DAYS", "30"))
+
+# Random (but fixed, so that boundaries are reproducible across runs and machines) value for each byte.
+# The rolling hash of a position is the sum of the values of the bytes in the window ending there
+_GEAR = np.random.default_rng(0x5EED).integers(0, 2 ** 63, size=256, dtype=np.uint64)
+
+
+def chunk_boundaries(data, avg_size=1 << 19, min_size=1 << 17, max_size=1 << 22, window=64):
+    """
+    Find content-defined chunk boundaries in a buffer. A position is a candidate boundary when the rolling
+    hash of the `window` bytes ending there has its low bits equal to zero, so boundaries depend only on the
+    local content and an insertion or deletion only changes the chunks around it. The rolling hash is
+    computed for the whole buffer at once with a cumulative sum
+
+    :param data: bytes-like buffer
+    :param avg_size: expected chunk size (must be a power of 2)
+    :param min_size: minimum chunk size (must be larger than window)
+    :param max_size: maximum chunk size
+    :param window: number of bytes in the rolling hash window
+    :return: list of chunk end offsets. The last chunk of the buffer is not included, unless it is
+             terminated by a content-defined boundary or by max_size
+    """
+    buf = np.frombuffer(data, dtype=np.uint8)
+    if buf.shape[0] <= window:
+        return []
+
+    # Sums modulo 2**64, wrapping on overflow is intended
+    with np.errstate(over="ignore"):
+        cumulative = np.cumsum(_GEAR[buf], dtype=np.uint64)
+        rolling = cumulative[window - 1:] - np.concatenate(([np.uint64(0)], cumulative[:-window]))
+    # Hash at index i covers bytes [i, i + window), the boundary is after the last byte
+    candidates = np.flatnonzero((rolling & np.uint64(avg_size - 1)) == 0) + window
+
+    boundaries = []
+    start = 0
+    while True:
+        i = np.searchsorted(candidates, start + min_size)
+        if i < candidates.shape[0] and candidates[i] <= start + max_size:
+            end = int(candidates[i])
+        elif start + max_size <= buf.shape[0]:
+            end = start + max_size
+        else:
+            return boundaries
+        boundaries.append(end)
+        start = end
+
+
+def iter_chunks(path, block_size=1 << 23, **kwargs):
+    """
+    Split a file into content-defined chunks, reading it in blocks so that memory use is bounded
+
+    :param path: path of the file
+    :param block_size: number of bytes read at a time
+    :param kwargs: passed to chunk_boundaries
+    :return: generator of chunks (bytes)
+    """
+    leftover = b""
+    with open(path, "rb") as fp:
+        for block in iter(lambda: fp.read(block_size), b""):
+            buffer = leftover + block
+            start = 0
+            for end in chunk_boundaries(buffer, **kwargs):
+                yield buffer[start:end]
+                start = end
+            leftover = buffer[start:]
+    if leftover:
+        yield leftover
+
+
+class LocalChunkStore:
+    """
+    Content-addressed store of compressed chunks in a local directory, one file per chunk named by the
+    sha256 of its uncompressed content
+    """
+
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def path(self, digest):
+        return os.path.join(self.root, digest)
+
+    def has(self, digest):
+        return os.path.exists(self.path(digest))
+
+    def touch(self, digest):
+        # The modification time records the last use, for prune
+        os.utime(self.path(digest))
+
+    def put(self, digest, compressed):
+        # Write to a temporary file first, so that a partially written chunk is never visible
+        tmp_path = self.path(digest) + ".tmp"
+        with open(tmp_path, "wb") as fp:
+            fp.write(compressed)
+        os.replace(tmp_path, self.path(digest))
+
+    def get(self, digest):
+        with open(self.path(digest), "rb") as fp:
+            return fp.read()
+
+    def prune(self, max_bytes, max_age_days, keep=()):
+        """
+        Remove the chunks unused for more than max_age_days, then the least recently used ones until the
+        store is smaller than max_bytes
+
+        :param max_bytes: maximum total size of the chunks
+        :param max_age_days: maximum number of days since a chunk was last used
+        :param keep: digests that must not be removed (e.g. the chunks of an artifact being logged)
+        :return: number of chunks removed
+        """
+        keep = set(keep)
+        chunks = []
+        for entry in os.scandir(self.root):
+            if entry.is_file() and not entry.name.endswith(".tmp"):
+                stat = entry.stat()
+                chunks.append((stat.st_mtime, stat.st_size, entry.name))
+        chunks.sort()
+        total = sum(size for _, size, _ in chunks)
+        oldest_allowed = time.time() - max_age_days * 86400
+        removed = 0
+        for mtime, size, digest in chunks:
+            if total <= max_bytes and mtime >= oldest_allowed:
+                break
+            if digest in keep:
+                continue
+            try:
+                os.remove(self.path(digest))
+            except FileNotFoundError:
+                # Already removed by a concurrent prune
+                pass
+            total -= size
+            removed += 1
+        if removed:
+            logger.info(f"Pruned {removed} chunks from {self.root}, {total / 1e6:.1f} MB left")
+        return removed
+
+
+def pack(path, store, compress_level=6, **kwargs):
+    """
+    Split a file, or all the files in a directory, into chunks and add to the store the chunks it does not
+    already have
+
+    :param path: file or directory to pack
+    :param store: chunk store (e.g. a LocalChunkStore)
+    :param compress_level: zlib compression level
+    :param kwargs: passed to chunk_boundaries
+    :return: the manifest (a dictionary) needed to rebuild the files from the store
+    """
+    if os.path.isdir(path):
+        files = sorted(
+            os.path.relpath(os.path.join(root, f), path) for root, _, names in os.walk(path) for f in names
+        )
+        base = path
+    else:
+        files = [os.path.basename(path)]
+        base = os.path.dirname(path)
+
+    manifest = {"files": [], "chunks": {}}
+    new_bytes = 0
+    total_bytes = 0
+    for rel_path in files:
+        file_digest = hashlib.sha256()
+        file_chunks = []
+        for chunk in iter_chunks(os.path.join(base, rel_path), **kwargs):
+            digest = hashlib.sha256(chunk).hexdigest()
+            file_digest.update(chunk)
+            file_chunks.append(digest)
+            total_bytes += len(chunk)
+            if digest not in manifest["chunks"]:
+                if not store.has(digest):
+                    compressed = zlib.compress(chunk, compress_level)
+                    store.put(digest, compressed)
+                    new_bytes += len(compressed)
+                else:
+                    store.touch(digest)
+                manifest["chunks"][digest] = len(chunk)
+        manifest["files"].append(
+            {"path": rel_path, "sha256": file_digest.hexdigest(), "chunks": file_chunks}
+        )
+
+    logger.info(
+        f"Packed {len(files)} file(s), {total_bytes / 1e6:.1f} MB in {len(manifest['chunks'])} chunks, "
+        f"{new_bytes / 1e6:.1f} MB of new compressed chunks"
+    )
+    return manifest
+
+
+def unpack(manifest, store, dest):
+    """
+    Rebuild the files described by a manifest
+
+    :param manifest: manifest returned by pack
+    :param store: chunk store containing all the chunks of the manifest
+    :param dest: destination directory
+    :return: None
+    """
+    for entry in manifest["files"]:
+        file_path = os.path.join(dest, entry["path"])
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        file_digest = hashlib.sha256()
+        with open(file_path, "wb") as fp:
+            for digest in entry["chunks"]:
+                chunk = zlib.decompress(store.get(digest))
+                file_digest.update(chunk)
+                fp.write(chunk)
+        if file_digest.hexdigest() != entry["sha256"]:
+            raise ValueError(f"Checksum mismatch while rebuilding {entry['path']}")
+
+
+def build_chunked_artifact(artifact_name, artifact_type, artifact_description, path, metadata=None,
+                           cache_dir=DEFAULT_CACHE_DIR):
+    """
+    Create a W&B artifact containing the chunk manifest of path plus its compressed chunks, each one named
+    after its digest. W&B does not upload again files it already stores, so only the chunks that changed
+    since the previous versions are transferred
+
+    :param artifact_name: name for the artifact
+    :param artifact_type: type for the artifact
+    :param artifact_description: a brief description of the artifact
+    :param path: file or directory to pack
+    :param metadata: optional dictionary of metadata for the artifact
+    :param cache_dir: local chunk store used to stage the chunks
+    :return: the wandb.Artifact, ready to be logged
+    """
+    store = LocalChunkStore(cache_dir)
+    manifest = pack(path, store)
+    store.prune(CACHE_MAX_BYTES, CACHE_MAX_AGE_DAYS, keep=manifest["chunks"])
+
+    # The cache is shared between runs, so the manifest is written to a directory of its own
+    manifest_path = os.path.join(tempfile.mkdtemp(prefix="chunk_manifest_"), MANIFEST_NAME)
+    with open(manifest_path, "w") as fp:
+        json.dump(manifest, fp)
+
+    artifact = wandb.Artifact(
+        artifact_name,
+        type=artifact_type,
+        description=artifact_description,
+        metadata={**(metadata or {}), "chunked": True},
+    )
+    artifact.add_file(manifest_path, name=MANIFEST_NAME)
+    for digest in manifest["chunks"]:
+        artifact.add_file(store.path(digest), name=f"{CHUNKS_DIR}/{digest}")
+    return artifact
+
+
+def log_chunked_artifact(artifact_name, artifact_type, artifact_description, path, wandb_run, metadata=None,
+                         aliases=None):
+    """
+    Log the file or directory at path as a chunked artifact (see build_chunked_artifact)
+
+    :param artifact_name: name for the artifact
+    :param artifact_type: type for the artifact
+    :param artifact_description: a brief description of the artifact
+    :param path: file or directory to log
+    :param wandb_run: current Weights & Biases run
+    :param metadata: optional dictionary of metadata for the artifact
+    :param aliases: optional list of aliases for the artifact
+    :return: None
+    """
+    artifact = build_chunked_artifact(artifact_name, artifact_type, artifact_description, path, metadata)
+    wandb_run.log_artifact(artifact, aliases=aliases)
+    artifact.wait()
+
+
+def download_dir(artifact):
+    """
+    Download an artifact and return the local directory with its files. Chunked artifacts are rebuilt from
+    their chunks, plain artifacts are returned as downloaded
+
+    :param artifact: the artifact, as returned by run.use_artifact
+    :return: path of the local directory
+    """
+    root = artifact.download()
+    if not (artifact.metadata or {}).get("chunked"):
+        return root
+
+    dest = os.path.join(root, "files")
+    if not os.path.isdir(dest):
+        with open(os.path.join(root, MANIFEST_NAME)) as fp:
+            manifest = json.load(fp)
+        unpack(manifest, LocalChunkStore(os.path.join(root, CHUNKS_DIR)), dest + ".tmp")
+        os.replace(dest + ".tmp", dest)
+    return dest
+
+
+def download_file(artifact):
+    """
+    Same as download_dir, for artifacts containing a single file
+
+    :param artifact: the artifact, as returned by run.use_artifact
+    :return: path of the local file
+    """
+    root = download_dir(artifact)
+    files = [f for f in os.listdir(root) if os.path.isfile(os.path.join(root, f))]
+    if len(files) != 1:
+        raise ValueError(f"Artifact {artifact.name} contains {len(files)} files, expected exactly one")
+    return os.path.join(root, files[0])
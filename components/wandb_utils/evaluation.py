@@ -0,0 +1,86 @@
+import numpy as np
+import pandas as pd
+import wandb
+
+
+SEGMENT_COLUMNS = ["neighbourhood_group", "room_type"]
+ERROR_QUANTILES = [0.5, 0.9, 0.99]
+
+
+# Summary key of the number of evaluated rows ("n" alone is too generic for the run summary)
+N_ROWS_KEY = "eval_n_rows"
+
+
+def _metrics_from_sums(sums):
+    """
+    Compute MAE, RMSE and R2 from per-group sums of the errors and of the squared deviations of the target
+    """
+    n = sums["n"]
+    sse = sums["squared_error"]
+    sst = sums["total_squares"]
+    return pd.DataFrame({
+        "n": n,
+        "mae": sums["abs_error"] / n,
+        "rmse": np.sqrt(sse / n),
+        "r2": 1 - sse / sst.where(sst > 0),
+    })
+
+
+def evaluate(y_true, y_pred, segments=None, quantiles=ERROR_QUANTILES):
+    """
+    Compute regression metrics from a single set of predictions, globally and per segment
+
+    :param y_true: true values
+    :param y_pred: predicted values
+    :param segments: optional DataFrame (aligned with y_true) with the columns to segment the metrics by
+    :param quantiles: quantiles of the absolute error to report
+    :return: (dictionary of global metrics, DataFrame of per-segment metrics indexed by (column, value))
+    """
+    y_true = np.asarray(y_true, dtype=np.float64)
+    error = np.asarray(y_pred, dtype=np.float64) - y_true
+    frame = pd.DataFrame({
+        "n": 1,
+        "abs_error": np.abs(error),
+        "squared_error": error ** 2,
+        # Squared deviations from the mean (two passes), the one-pass sum(y^2) - sum(y)^2 / n loses precision
+        # when the prices are large compared with their spread
+        "total_squares": (y_true - y_true.mean()) ** 2,
+    })
+
+    global_metrics = _metrics_from_sums(frame.sum().to_frame().T).iloc[0].to_dict()
+    abs_error_quantiles = frame["abs_error"].quantile(quantiles)
+    for q, value in abs_error_quantiles.items():
+        global_metrics[f"abs_error_q{int(q * 100)}"] = value
+
+    segment_metrics = []
+    for column in ([] if segments is None else segments.columns):
+        keys = segments[column].to_numpy()
+        segment_y = pd.Series(y_true).groupby(keys, observed=True)
+        groups = frame.assign(total_squares=(y_true - segment_y.transform("mean").to_numpy()) ** 2).groupby(
+            keys, observed=True, sort=True
+        )
+        metrics = _metrics_from_sums(groups.sum())
+        segment_quantiles = groups["abs_error"].quantile(quantiles).unstack()
+        segment_quantiles.columns = [f"abs_error_q{int(q * 100)}" for q in segment_quantiles.columns]
+        metrics = metrics.join(segment_quantiles)
+        metrics.index = pd.MultiIndex.from_product([[column], metrics.index], names=["segment", "value"])
+        segment_metrics.append(metrics)
+
+    segment_metrics = pd.concat(segment_metrics) if segment_metrics else pd.DataFrame()
+    return global_metrics, segment_metrics
+
+
+def log_evaluation(wandb_run, global_metrics, segment_metrics, prefix=""):
+    """
+    Log the output of evaluate to W&B: global metrics in the run summary, segment metrics as a table
+
+    :param wandb_run: current Weights & Biases run
+    :param global_metrics: dictionary of global metrics
+    :param segment_metrics: DataFrame of per-segment metrics
+    :param prefix: optional prefix for the summary keys and the table name
+    :return: None
+    """
+    for name, value in global_metrics.items():
+        wandb_run.summary[f"{prefix}{N_ROWS_KEY if name == 'n' else name}"] = value
+    if not segment_metrics.empty:
+        wandb_run.log({f"{prefix}segment_metrics": wandb.Table(dataframe=segment_metrics.reset_index())})
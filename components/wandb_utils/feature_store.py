@@ -0,0 +1,238 @@
+import hashlib
+import json
+import logging
+import os
+
+import numpy as np
+import pandas as pd
+from sklearn.base import BaseEstimator, TransformerMixin
+from sklearn.feature_extraction.text import HashingVectorizer
+
+from wandb_utils.schema import NEIGHBOURHOOD_GROUPS, ROOM_TYPES
+
+
+logger = logging.getLogger(__name__)
+
+# Version of the feature definitions below. Bump it whenever ListingFeatures.transform changes, so that the
+# features computed with the old definitions are not served anymore
+FEATURE_VERSION = 1
+
+NUMERIC_COLUMNS = [
+    "minimum_nights",
+    "number_of_reviews",
+    "reviews_per_month",
+    "calculated_host_listings_count",
+    "availability_365",
+    "longitude",
+    "latitude",
+]
+# Raw columns read by ListingFeatures
+INPUT_COLUMNS = ["room_type", "neighbourhood_group"] + NUMERIC_COLUMNS + ["last_review", "name"]
+
+# Listings that were never reviewed get this date
+DEFAULT_LAST_REVIEW = "2010-01-01"
+
+_IDS_NAME = "ids.npy"
+_HASHES_NAME = "hashes.npy"
+_FEATURES_NAME = "features.npy"
+_MANIFEST_NAME = "manifest.json"
+
+
+class ListingFeatures(BaseEstimator, TransformerMixin):
+    """
+    Stateless features of a listing, computed from its own raw row only, so they can be stored and reused
+    by every model: the categories as codes of the known values (-1 for missing or unknown), the numeric
+    columns as float32 (missing values kept as NaN), last_review as days since the epoch and the name as
+    hashed n-gram counts. Everything that depends on the training data (imputation, encodings, IDF
+    weights, neighbourhood features) is left to the model
+    """
+
+    def __init__(self, n_name_features=256, ngram_range=(1, 2), stop_words="english"):
+        self.n_name_features = n_name_features
+        self.ngram_range = ngram_range
+        self.stop_words = stop_words
+
+    @property
+    def version(self):
+        """
+        Identifier of the feature definitions: FEATURE_VERSION and the parameters
+        """
+        params = json.dumps({"version": FEATURE_VERSION, **self.get_params()}, sort_keys=True)
+        return f"v{FEATURE_VERSION}-{hashlib.sha1(params.encode()).hexdigest()[:12]}"
+
+    @property
+    def name_columns(self):
+        return [f"name_{i:04d}" for i in range(self.n_name_features)]
+
+    def fit(self, X, y=None):
+        self.feature_names_in_ = np.array(INPUT_COLUMNS, dtype=object)
+        return self
+
+    def transform(self, X):
+        features = {
+            "room_type": pd.Categorical(X["room_type"], categories=ROOM_TYPES).codes.astype(np.float32),
+            "neighbourhood_group": pd.Categorical(
+                X["neighbourhood_group"], categories=NEIGHBOURHOOD_GROUPS
+            ).codes.astype(np.float32),
+        }
+        for c in NUMERIC_COLUMNS:
+            features[c] = pd.to_numeric(X[c], errors="coerce").to_numpy(dtype=np.float32, na_value=np.nan)
+
+        dates = pd.to_datetime(X["last_review"], errors="coerce").fillna(pd.Timestamp(DEFAULT_LAST_REVIEW))
+        features["last_review"] = ((dates - pd.Timestamp(0)).dt.days).to_numpy(dtype=np.float32)
+
+        hasher = HashingVectorizer(
+            n_features=self.n_name_features,
+            ngram_range=tuple(self.ngram_range),
+            stop_words=self.stop_words,
+            alternate_sign=False,
+            norm=None,
+        )
+        names = hasher.transform(X["name"].astype(object).where(X["name"].notna(), "").astype(str))
+        features = pd.DataFrame(features, index=X.index)
+        name_features = pd.DataFrame(names.toarray().astype(np.float32), columns=self.name_columns, index=X.index)
+        return pd.concat([features, name_features], axis=1)
+
+    def get_feature_names_out(self, input_features=None):
+        return np.array(INPUT_COLUMNS[:-1] + self.name_columns, dtype=object)
+
+    def column_groups(self):
+        """
+        Output columns of each input column (the name is spread over the hashed columns)
+
+        :return: dictionary of lists of output columns, keyed by input column
+        """
+        return {**{c: [c] for c in INPUT_COLUMNS[:-1]}, "name": self.name_columns}
+
+
+def input_hashes(df):
+    """
+    Hash the raw columns read by ListingFeatures, so that listings whose features must be recomputed can be
+    detected
+
+    :param df: raw DataFrame
+    :return: int64 array of row hashes
+    """
+    return pd.util.hash_pandas_object(df[INPUT_COLUMNS], index=False).to_numpy().view(np.int64)
+
+
+class FeatureStore:
+    """
+    Local store of the ListingFeatures of the listings, keyed by listing id, with one directory per version
+    of the feature definitions. The features are kept in a single column-major float32 .npy file that is
+    memory-mapped when read, so a lookup only touches the rows it needs, and are only recomputed for the
+    listings whose raw columns changed since they were stored
+    """
+
+    def __init__(self, root, featurizer):
+        """
+        :param root: root directory of the store
+        :param featurizer: a ListingFeatures, whose version selects the directory of the store
+        """
+        self.featurizer = featurizer
+        self.path = os.path.join(root, featurizer.version)
+        self.columns = list(featurizer.get_feature_names_out())
+        self._load()
+
+    def _load(self):
+        if os.path.exists(os.path.join(self.path, _MANIFEST_NAME)):
+            self.ids = np.load(os.path.join(self.path, _IDS_NAME))
+            self.hashes = np.load(os.path.join(self.path, _HASHES_NAME))
+            self.features = np.load(os.path.join(self.path, _FEATURES_NAME), mmap_mode="r")
+        else:
+            self.ids = np.empty(0, dtype=np.int64)
+            self.hashes = np.empty(0, dtype=np.int64)
+            self.features = np.empty((0, len(self.columns)), dtype=np.float32, order="F")
+
+    def __len__(self):
+        return self.ids.shape[0]
+
+    def _positions(self, ids):
+        # The ids are kept sorted
+        positions = np.searchsorted(self.ids, ids)
+        found = positions < len(self)
+        found[found] = self.ids[positions[found]] == ids[found]
+        return positions, found
+
+    def update(self, df):
+        """
+        Compute and store the features of the listings of df that are new or changed
+
+        :param df: raw DataFrame with the id column and the INPUT_COLUMNS
+        :return: number of listings whose features were computed
+        """
+        # If a listing appears more than once, its last row wins
+        df = df.drop_duplicates("id", keep="last")
+        ids = df["id"].to_numpy(dtype=np.int64)
+        hashes = input_hashes(df)
+        positions, found = self._positions(ids)
+        stale = ~found
+        stale[found] = self.hashes[positions[found]] != hashes[found]
+        logger.info(f"Feature store {self.featurizer.version}: computing {int(stale.sum())} of {ids.shape[0]} listings")
+        if not stale.any():
+            return 0
+
+        computed = self.featurizer.transform(df[stale]).to_numpy(dtype=np.float32)
+        kept = np.ones(len(self), dtype=bool)
+        kept[positions[found & stale]] = False
+        all_ids = np.concatenate([self.ids[kept], ids[stale]])
+        order = np.argsort(all_ids, kind="stable")
+
+        # The new version is written next to the current one and swapped in, column by column so that the
+        # memory used does not grow with the number of columns
+        os.makedirs(self.path, exist_ok=True)
+        tmp_path = os.path.join(self.path, f"{_FEATURES_NAME}.tmp")
+        features = np.lib.format.open_memmap(
+            tmp_path, mode="w+", dtype=np.float32, shape=(all_ids.shape[0], len(self.columns)), fortran_order=True
+        )
+        for j in range(len(self.columns)):
+            features[:, j] = np.concatenate([self.features[kept, j], computed[:, j]])[order]
+        features.flush()
+        del features
+        os.replace(tmp_path, os.path.join(self.path, _FEATURES_NAME))
+        np.save(os.path.join(self.path, _IDS_NAME), all_ids[order])
+        np.save(os.path.join(self.path, _HASHES_NAME), np.concatenate([self.hashes[kept], hashes[stale]])[order])
+        with open(os.path.join(self.path, _MANIFEST_NAME), "w") as fp:
+            json.dump(
+                {
+                    "version": self.featurizer.version,
+                    "params": self.featurizer.get_params(),
+                    "columns": self.columns,
+                    "n_listings": int(all_ids.shape[0]),
+                },
+                fp,
+            )
+        self._load()
+        return int(stale.sum())
+
+    def lookup(self, ids, columns=None):
+        """
+        Read the stored features of listings
+
+        :param ids: listing ids
+        :param columns: optional list of the feature columns to read (by default all of them)
+        :return: DataFrame of features, in the order of ids
+        """
+        ids = np.asarray(ids, dtype=np.int64)
+        positions, found = self._positions(ids)
+        if not found.all():
+            raise KeyError(f"{int((~found).sum())} listings are not in the feature store, update it first")
+        if columns is None:
+            return pd.DataFrame(self.features[positions], columns=self.columns)
+        return pd.DataFrame(
+            {c: self.features[positions, self.columns.index(c)] for c in columns}, columns=columns
+        )
+
+
+class StoredFeaturesModel:
+    """
+    Fitted pipeline starting with a ListingFeatures step whose predictions read the features of the rows
+    from a FeatureStore by listing id, instead of computing them
+    """
+
+    def __init__(self, model, store):
+        self.model = model
+        self.store = store
+
+    def predict(self, X):
+        return self.model[1:].predict(self.store.lookup(X["id"]))
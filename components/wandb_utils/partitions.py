@@ -0,0 +1,231 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from wandb_utils.chunked_artifact import download_dir
+from wandb_utils.schema import CATEGORICAL_COLUMNS, COLUMNS, read_columns, read_csv
+
+
+PARTITIONS_DIR = "partitions"
+WATERMARK_NAME = "watermark.json"
+WATERMARK_ARRAYS_NAME = "watermark.npz"
+
+
+def row_hashes(df):
+    """
+    Hash each row of a raw dataset over the schema columns, so that changed listings can be detected
+
+    :param df: DataFrame with the schema columns
+    :return: int64 array of row hashes
+    """
+    return pd.util.hash_pandas_object(df[COLUMNS], index=False).to_numpy().view(np.int64)
+
+
+class Watermark:
+    """
+    State of an incrementally cleaned dataset: for every listing id seen so far, the hash of its last raw
+    row and the partition where that row was last processed, plus the digests of the source files
+    already ingested and the most recent last_review date
+    """
+
+    def __init__(self, ids=None, hashes=None, last_partition=None, partitions=None, source_digests=None,
+                 max_last_review=None):
+        self.ids = np.asarray([] if ids is None else ids, dtype=np.int64)
+        self.hashes = np.asarray([] if hashes is None else hashes, dtype=np.int64)
+        self.last_partition = np.asarray([] if last_partition is None else last_partition, dtype=np.int32)
+        self.partitions = list(partitions or [])
+        self.source_digests = list(source_digests or [])
+        self.max_last_review = max_last_review
+
+    @classmethod
+    def load(cls, root):
+        """
+        Load the watermark of the partitioned dataset in root, or an empty one if root is not partitioned
+        """
+        if root is None or not os.path.exists(os.path.join(root, WATERMARK_NAME)):
+            return cls()
+        with open(os.path.join(root, WATERMARK_NAME)) as fp:
+            state = json.load(fp)
+        with np.load(os.path.join(root, WATERMARK_ARRAYS_NAME)) as arrays:
+            return cls(arrays["ids"], arrays["hashes"], arrays["last_partition"], **state)
+
+    def save(self, root):
+        with open(os.path.join(root, WATERMARK_NAME), "w") as fp:
+            json.dump(
+                {
+                    "partitions": self.partitions,
+                    "source_digests": self.source_digests,
+                    "max_last_review": self.max_last_review,
+                },
+                fp,
+            )
+        np.savez_compressed(
+            os.path.join(root, WATERMARK_ARRAYS_NAME),
+            ids=self.ids,
+            hashes=self.hashes,
+            last_partition=self.last_partition,
+        )
+
+    def delta(self, df):
+        """
+        Return a boolean mask of the rows of a raw dataset that are new or changed since the watermark
+
+        :param df: raw DataFrame with the schema columns
+        :return: (mask, row hashes of df)
+        """
+        hashes = row_hashes(df)
+        positions = pd.Index(self.ids).get_indexer(df["id"].to_numpy())
+        known = positions >= 0
+        mask = ~known
+        mask[known] = self.hashes[positions[known]] != hashes[known]
+        return mask, hashes
+
+    def advance(self, ids, hashes, partition, source_digest, last_review):
+        """
+        Record that the given listings (with their raw row hashes) were processed in a new partition
+
+        :param ids: listing ids of the processed rows
+        :param hashes: raw row hashes of the processed rows
+        :param partition: file name of the new partition
+        :param source_digest: digest of the source file
+        :param last_review: last_review column of the processed rows
+        """
+        # If a listing appears more than once in the delta, its last row wins
+        delta = pd.DataFrame({"id": ids, "hash": hashes}).drop_duplicates("id", keep="last")
+        partition_number = len(self.partitions)
+        self.partitions.append(partition)
+        self.source_digests.append(source_digest)
+
+        positions = pd.Index(self.ids).get_indexer(delta["id"].to_numpy())
+        known = positions >= 0
+        self.hashes[positions[known]] = delta["hash"].to_numpy()[known]
+        self.last_partition[positions[known]] = partition_number
+        self.ids = np.concatenate([self.ids, delta["id"].to_numpy()[~known]])
+        self.hashes = np.concatenate([self.hashes, delta["hash"].to_numpy()[~known]])
+        self.last_partition = np.concatenate(
+            [self.last_partition, np.full((~known).sum(), partition_number, dtype=np.int32)]
+        )
+
+        max_last_review = pd.to_datetime(pd.Series(last_review), errors="coerce").max()
+        if pd.notna(max_last_review):
+            max_last_review = max_last_review.strftime("%Y-%m-%d")
+            self.max_last_review = max(filter(None, [self.max_last_review, max_last_review]))
+
+
+def is_partitioned(path):
+    return os.path.isdir(path) and os.path.exists(os.path.join(path, WATERMARK_NAME))
+
+
+def _read_current_rows(path, watermark, partition_number, columns, **kwargs):
+    """
+    Read a partition, keeping only the rows that are still the latest version of their listing
+    """
+    last_partition = pd.Series(watermark.last_partition, index=watermark.ids)
+    df = read_csv(os.path.join(path, PARTITIONS_DIR, watermark.partitions[partition_number]), usecols=columns, **kwargs)
+    current = last_partition.reindex(df["id"].to_numpy()).to_numpy() == partition_number
+    return df[current]
+
+
+def _projection(usecols):
+    # The id column is always needed to find the current version of each listing
+    return None if usecols is None else list(dict.fromkeys(["id"] + list(usecols)))
+
+
+def read_dataset(path, usecols=None, **kwargs):
+    """
+    Read a cleaned dataset, either a single CSV file or a partitioned dataset. For a partitioned dataset
+    only the most recent version of every listing is kept (listings dropped by the cleaning of a later
+    partition are removed), and rows are returned in partition order
+
+    :param path: CSV file or directory of a partitioned dataset
+    :param usecols: optional list of columns to load
+    :param kwargs: passed to schema.read_csv
+    :return: a DataFrame
+    """
+    if not is_partitioned(path):
+        return read_csv(path, usecols=usecols, **kwargs)
+
+    watermark = Watermark.load(path)
+    columns = _projection(usecols)
+    frames = [
+        _read_current_rows(path, watermark, partition_number, columns, **kwargs)
+        for partition_number in range(len(watermark.partitions))
+    ]
+
+    df = pd.concat(frames, ignore_index=True)
+    # Concatenating categoricals with different categories falls back to object, restore the schema dtypes
+    df = df.astype({c: "category" for c in CATEGORICAL_COLUMNS if c in df.columns})
+    return df if usecols is None or "id" in usecols else df.drop(columns="id")
+
+
+def read_partition(path, partition=-1, usecols=None, **kwargs):
+    """
+    Read the current rows of a single partition of a dataset, by default the one added by the latest
+    incremental cleaning. A dataset that is not partitioned is read as a whole
+
+    :param path: CSV file or directory of a partitioned dataset
+    :param partition: position of the partition in the watermark (negative values count from the end)
+    :param usecols: optional list of columns to load
+    :param kwargs: passed to schema.read_csv
+    :return: a DataFrame
+    """
+    if not is_partitioned(path):
+        return read_csv(path, usecols=usecols, **kwargs)
+
+    watermark = Watermark.load(path)
+    partition_number = range(len(watermark.partitions))[partition]
+    df = _read_current_rows(path, watermark, partition_number, _projection(usecols), **kwargs)
+    df = df.reset_index(drop=True)
+    return df if usecols is None or "id" in usecols else df.drop(columns="id")
+
+
+def dataset_columns(path):
+    """
+    Read the column names of a dataset (single CSV file or partitioned) without parsing any row
+
+    :param path: CSV file or directory of a partitioned dataset
+    :return: list of the column names
+    """
+    if not is_partitioned(path):
+        return read_columns(path)
+    watermark = Watermark.load(path)
+    return read_columns(os.path.join(path, PARTITIONS_DIR, watermark.partitions[0]))
+
+
+def dataset_path(artifact):
+    """
+    Download a cleaned dataset artifact and return the path to pass to read_dataset: the directory for a
+    partitioned dataset, the CSV file otherwise
+
+    :param artifact: the artifact, as returned by run.use_artifact
+    :return: local path of the dataset
+    """
+    root = download_dir(artifact)
+    if is_partitioned(root):
+        return root
+    files = [f for f in os.listdir(root) if os.path.isfile(os.path.join(root, f))]
+    if len(files) != 1:
+        raise ValueError(f"Artifact {artifact.name} contains {len(files)} files, expected exactly one")
+    return os.path.join(root, files[0])
+
+
+def dataset_digest(path):
+    """
+    Compute the sha256 digest of a dataset (of the file, or of all the files of a partitioned dataset in
+    path order), reading the files in blocks
+
+    :param path: CSV file or directory of a partitioned dataset
+    :return: the hex digest
+    """
+    paths = [path] if os.path.isfile(path) else sorted(
+        os.path.join(root, f) for root, _, names in os.walk(path) for f in names
+    )
+    digest = hashlib.sha256()
+    for file_path in paths:
+        with open(file_path, "rb") as fp:
+            for block in iter(lambda: fp.read(1 << 20), b""):
+                digest.update(block)
+    return digest.hexdigest()
@@ -0,0 +1,152 @@
+import hashlib
+import logging
+import os
+import sqlite3
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+
+logger = logging.getLogger(__name__)
+
+
+def _canonicalize(X):
+    """
+    Return a version of X whose hash does not depend on column order or dtype details: columns sorted by
+    name, numbers as float64 (missing values as NaN) and everything else as strings
+    """
+    columns = {}
+    for c in sorted(X.columns):
+        col = X[c]
+        if pd.api.types.is_numeric_dtype(col) and not pd.api.types.is_bool_dtype(col):
+            columns[c] = col.to_numpy(dtype="float64", na_value=np.nan)
+        else:
+            columns[c] = col.astype(object).where(col.notna(), None).astype(str).to_numpy()
+    return pd.DataFrame(columns)
+
+
+class PredictionCache:
+    """
+    Two-tier cache of model predictions. Every row is keyed by a 128-bit hash of the model version, the
+    feature names and the canonicalized feature values, so only rows that are new or changed (or scored
+    with a different model) reach the model. Recent keys are kept in an in-memory LRU, and optionally
+    all keys are persisted in a SQLite file so they survive across runs
+    """
+
+    def __init__(self, model_version, max_entries=1000000, cache_dir=None):
+        """
+        :param model_version: string identifying the model (e.g. the artifact digest)
+        :param max_entries: maximum number of predictions kept in memory
+        :param cache_dir: optional directory for the on-disk tier
+        """
+        self.model_version = model_version
+        self.max_entries = max_entries
+        self._memory = OrderedDict()
+        self._db = None
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            self._db = sqlite3.connect(os.path.join(cache_dir, "predictions.sqlite"))
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS predictions "
+                "(k1 INTEGER, k2 INTEGER, prediction REAL, PRIMARY KEY (k1, k2)) WITHOUT ROWID"
+            )
+        self.stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0}
+
+    def keys(self, X):
+        """
+        Compute the cache keys of the rows of X
+
+        :param X: features DataFrame
+        :return: two int64 arrays (the high and low halves of the 128-bit keys)
+        """
+        seed = hashlib.sha256(f"{self.model_version}|{','.join(sorted(X.columns))}".encode()).hexdigest()
+        canonical = _canonicalize(X)
+        return tuple(
+            pd.util.hash_pandas_object(canonical, index=False, hash_key=hash_key).to_numpy().view(np.int64)
+            for hash_key in (seed[:16], seed[16:32])
+        )
+
+    def _get_memory(self, k1, k2):
+        found = np.full(k1.shape[0], np.nan)
+        for i, key in enumerate(zip(k1.tolist(), k2.tolist())):
+            prediction = self._memory.get(key)
+            if prediction is not None:
+                self._memory.move_to_end(key)
+                found[i] = prediction
+        return found
+
+    def _put_memory(self, k1, k2, predictions):
+        for key, prediction in zip(zip(k1.tolist(), k2.tolist()), predictions.tolist()):
+            self._memory[key] = prediction
+            self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    def _get_disk(self, k1, k2):
+        found = np.full(k1.shape[0], np.nan)
+        self._db.execute("CREATE TEMP TABLE IF NOT EXISTS lookup (k1 INTEGER, k2 INTEGER, pos INTEGER)")
+        self._db.executemany(
+            "INSERT INTO lookup VALUES (?, ?, ?)", zip(k1.tolist(), k2.tolist(), range(k1.shape[0]))
+        )
+        rows = self._db.execute(
+            "SELECT l.pos, p.prediction FROM lookup l JOIN predictions p ON p.k1 = l.k1 AND p.k2 = l.k2"
+        ).fetchall()
+        self._db.execute("DELETE FROM lookup")
+        if rows:
+            positions, predictions = zip(*rows)
+            found[list(positions)] = predictions
+        return found
+
+    def _put_disk(self, k1, k2, predictions):
+        self._db.executemany(
+            "INSERT OR REPLACE INTO predictions VALUES (?, ?, ?)",
+            zip(k1.tolist(), k2.tolist(), predictions.tolist()),
+        )
+        self._db.commit()
+
+    def predict(self, model, X):
+        """
+        Predict X, running the model only on the rows that are not in the cache
+
+        :param model: fitted model with a predict method
+        :param X: features DataFrame
+        :return: array of predictions, in the order of X
+        """
+        k1, k2 = self.keys(X)
+        predictions = self._get_memory(k1, k2)
+        missing = np.isnan(predictions)
+        self.stats["memory_hits"] += int((~missing).sum())
+
+        if self._db is not None and missing.any():
+            from_disk = self._get_disk(k1[missing], k2[missing])
+            predictions[missing] = from_disk
+            hit = ~np.isnan(from_disk)
+            self.stats["disk_hits"] += int(hit.sum())
+            # Promote the rows found on disk to the memory tier
+            self._put_memory(k1[missing][hit], k2[missing][hit], from_disk[hit])
+            missing = np.isnan(predictions)
+
+        self.stats["misses"] += int(missing.sum())
+        if missing.any():
+            computed = np.asarray(model.predict(X[missing]), dtype=np.float64)
+            predictions[missing] = computed
+            self._put_memory(k1[missing], k2[missing], computed)
+            if self._db is not None:
+                self._put_disk(k1[missing], k2[missing], computed)
+
+        logger.info(
+            f"Prediction cache: {X.shape[0] - int(missing.sum())}/{X.shape[0]} rows served from the cache, "
+            f"{int(missing.sum())} predicted"
+        )
+        return predictions
+
+    @property
+    def hit_rate(self):
+        total = sum(self.stats.values())
+        return (self.stats["memory_hits"] + self.stats["disk_hits"]) / total if total else 0.0
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
@@ -0,0 +1,151 @@
+import numpy as np
+
+
+class KLLSketch:
+    """
+    Mergeable streaming quantile sketch (KLL). Values are kept in a hierarchy of compactors, where an item of
+    level h stands for 2^h values of the stream. When a level is over capacity it is sorted and every other
+    item (with a random offset) is promoted to the next level. The memory is O(k) whatever the length of the
+    stream, and the rank error of a quantile is about 1.7 / k
+    """
+
+    def __init__(self, k=1000, random_seed=None):
+        """
+        :param k: size of the largest compactor, which sets the accuracy
+        :param random_seed: seed for the compaction offsets
+        """
+        self.k = k
+        self.n = 0
+        self.min = np.inf
+        self.max = -np.inf
+        self.levels = [np.empty(0)]
+        self._rng = np.random.default_rng(random_seed)
+
+    def _capacity(self, level):
+        # Lower levels get geometrically smaller compactors
+        depth = len(self.levels) - level - 1
+        return max(2, int(np.ceil(self.k * (2 / 3) ** depth)))
+
+    def _add(self, level, values):
+        while len(self.levels) <= level:
+            self.levels.append(np.empty(0))
+        self.levels[level] = np.concatenate([self.levels[level], values])
+
+    def _compress(self):
+        # Adding a level shrinks the capacity of the ones below, so compact until every level fits
+        while True:
+            over = [h for h, items in enumerate(self.levels) if items.shape[0] > self._capacity(h)]
+            if not over:
+                return
+            level = over[0]
+            items = np.sort(self.levels[level])
+            # With an odd number of items, the largest one stays at this level
+            keep = items[items.shape[0] - items.shape[0] % 2:]
+            self._add(level + 1, items[self._rng.integers(2):items.shape[0] - keep.shape[0]:2])
+            self.levels[level] = keep
+
+    def update(self, values):
+        """
+        Add a batch of values to the sketch (missing values are ignored)
+
+        :param values: array-like of numbers
+        """
+        values = np.asarray(values, dtype=np.float64)
+        values = values[~np.isnan(values)]
+        if values.shape[0] == 0:
+            return
+        self.n += values.shape[0]
+        self.min = min(self.min, values.min())
+        self.max = max(self.max, values.max())
+
+        # A large batch is sorted once and compacted straight to the level where it fits, which is the same as
+        # compacting it level by level (halving a sorted array keeps it sorted)
+        level = 0
+        if values.shape[0] > self.k:
+            values = np.sort(values)
+            while values.shape[0] > self.k:
+                values = values[self._rng.integers(2)::2]
+                level += 1
+        self._add(level, values)
+        self._compress()
+
+    def merge(self, other):
+        """
+        Merge another sketch into this one
+
+        :param other: a KLLSketch
+        :return: this sketch
+        """
+        self.n += other.n
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        for level, items in enumerate(other.levels):
+            self._add(level, items)
+        self._compress()
+        return self
+
+    def quantile(self, q):
+        """
+        Estimate quantiles of the stream
+
+        :param q: quantile or array of quantiles in [0, 1]
+        :return: the estimated quantile(s)
+        """
+        q = np.asarray(q, dtype=np.float64)
+        if self.n == 0:
+            return np.full(q.shape, np.nan)[()]
+        items = np.concatenate(self.levels)
+        weights = np.concatenate([np.full(level.shape[0], 2.0 ** h) for h, level in enumerate(self.levels)])
+        order = np.argsort(items)
+        items, cumulative = items[order], np.cumsum(weights[order])
+        positions = np.searchsorted(cumulative, q * cumulative[-1], side="left")
+        result = items[np.clip(positions, 0, items.shape[0] - 1)]
+        # The extremes are tracked exactly
+        result = np.where(q <= 0, self.min, np.where(q >= 1, self.max, result))
+        return result[()]
+
+    def to_dict(self):
+        return {
+            "k": self.k,
+            "n": int(self.n),
+            "min": float(self.min),
+            "max": float(self.max),
+            "levels": [items.tolist() for items in self.levels],
+        }
+
+    @classmethod
+    def from_dict(cls, state):
+        sketch = cls(k=state["k"])
+        sketch.n = state["n"]
+        sketch.min = state["min"]
+        sketch.max = state["max"]
+        sketch.levels = [np.asarray(items, dtype=np.float64) for items in state["levels"]]
+        return sketch
+
+
+def sketch_columns(chunks, columns, k=1000, random_seed=None):
+    """
+    Build one sketch per column over a stream of DataFrame chunks
+
+    :param chunks: iterable of DataFrames
+    :param columns: numeric columns to sketch
+    :param k: accuracy parameter of the sketches
+    :param random_seed: seed for the compaction offsets
+    :return: dictionary of KLLSketch, keyed by column
+    """
+    sketches = {c: KLLSketch(k=k, random_seed=random_seed) for c in columns}
+    for chunk in chunks:
+        for c in columns:
+            sketches[c].update(chunk[c].to_numpy(dtype=np.float64, na_value=np.nan))
+    return sketches
+
+
+def quantile_bounds(sketches, quantiles):
+    """
+    Derive [lower, upper] bounds for sketched columns
+
+    :param sketches: dictionary of KLLSketch, keyed by column
+    :param quantiles: dictionary of (lower quantile, upper quantile), keyed by column
+    :return: dictionary of [lower, upper], keyed by column
+    """
+    return {c: [float(v) for v in sketches[c].quantile(list(q))] for c, q in quantiles.items()}
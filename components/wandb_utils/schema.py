@@ -0,0 +1,209 @@
+import numpy as np
+import pandas as pd
+
+try:
+    import pyarrow as pa
+    import pyarrow.csv as pa_csv
+except ImportError:
+    # Without pyarrow the files are parsed with the (single-threaded) pandas C engine
+    pa = None
+
+
+# Columns of the NYC Airbnb dataset, in the order they appear in the raw and cleaned files
+COLUMNS = [
+    "id",
+    "name",
+    "host_id",
+    "host_name",
+    "neighbourhood_group",
+    "neighbourhood",
+    "latitude",
+    "longitude",
+    "room_type",
+    "price",
+    "minimum_nights",
+    "number_of_reviews",
+    "last_review",
+    "reviews_per_month",
+    "calculated_host_listings_count",
+    "availability_365",
+]
+
+# Known values of the low-cardinality categorical columns
+NEIGHBOURHOOD_GROUPS = ["Bronx", "Brooklyn", "Manhattan", "Queens", "Staten Island"]
+ROOM_TYPES = ["Entire home/apt", "Private room", "Shared room"]
+
+# Geographical box of New York City, used to drop invalid geolocations
+NYC_BOUNDS = {"longitude": (-74.25, -73.50), "latitude": (40.5, 41.2)}
+
+CATEGORICAL_COLUMNS = ["host_name", "neighbourhood_group", "neighbourhood", "room_type"]
+DATE_COLUMNS = ["last_review"]
+
+# Memory-optimized dtypes. Categorical columns are read as unconstrained categories (values outside the
+# known sets above must survive the load so that data_check can flag them), counts use the smallest
+# nullable integer type that fits, so that missing values in new drops do not force a float64 column
+DTYPES = {
+    "id": "int64",
+    "name": "object",
+    "host_id": "int64",
+    "host_name": "category",
+    "neighbourhood_group": "category",
+    "neighbourhood": "category",
+    "latitude": "float32",
+    "longitude": "float32",
+    "room_type": "category",
+    "price": "Int32",
+    "minimum_nights": "Int32",
+    "number_of_reviews": "Int32",
+    "reviews_per_month": "float32",
+    "calculated_host_listings_count": "Int16",
+    "availability_365": "Int16",
+}
+
+
+def dtypes_for(columns):
+    """
+    Return the dtypes of the given columns, for the columns that have one in the schema
+
+    :param columns: list of column names
+    :return: dictionary column -> dtype
+    """
+    return {c: DTYPES[c] for c in columns if c in DTYPES}
+
+
+def _arrow_type(dtype):
+    return {
+        "int64": pa.int64(),
+        "float32": pa.float32(),
+        "Int32": pa.int32(),
+        "Int16": pa.int16(),
+        # Dictionary-encoded columns are converted straight to pandas categoricals
+        "category": pa.dictionary(pa.int32(), pa.string()),
+        "object": pa.string(),
+    }[dtype]
+
+
+def _arrow_options(columns, parse_dates):
+    column_types = {c: _arrow_type(DTYPES[c]) for c in columns if c in DTYPES}
+    for c in DATE_COLUMNS:
+        if c in columns:
+            column_types[c] = pa.timestamp("s") if parse_dates else pa.string()
+    read_options = pa_csv.ReadOptions(use_threads=True)
+    # Empty strings are missing values, as with pandas
+    convert_options = pa_csv.ConvertOptions(
+        include_columns=columns, column_types=column_types, strings_can_be_null=True
+    )
+    # Listing names can contain quoted line breaks
+    parse_options = pa_csv.ParseOptions(newlines_in_values=True)
+    return read_options, parse_options, convert_options
+
+
+def _to_pandas(table):
+    # Nullable integers keep their schema dtype instead of becoming float64 when there are missing values
+    df = table.to_pandas(types_mapper={pa.int32(): pd.Int32Dtype(), pa.int16(): pd.Int16Dtype()}.get)
+    # Arrow orders the categories by first appearance, pandas sorts them
+    for c in df.columns:
+        if isinstance(df[c].dtype, pd.CategoricalDtype):
+            df[c] = df[c].cat.reorder_categories(sorted(df[c].cat.categories))
+    # Missing strings come out as None, which SimpleImputer does not impute: they are NaN with pd.read_csv
+    strings = [c for c in df.columns if df[c].dtype == object]
+    df[strings] = df[strings].where(df[strings].notna(), np.nan)
+    return df
+
+
+def _projection(usecols):
+    # The columns are returned in file order, as pd.read_csv does with usecols
+    if usecols is None:
+        return list(COLUMNS)
+    return sorted(usecols, key=lambda c: COLUMNS.index(c) if c in COLUMNS else len(COLUMNS))
+
+
+def read_csv(path, usecols=None, parse_dates=True, engine="auto", **kwargs):
+    """
+    Read a raw or cleaned dataset with the schema dtypes. When pyarrow is available the file is parsed by
+    the Arrow multi-threaded reader, which only materializes the requested columns and converts them to
+    the schema dtypes during the parse
+
+    :param path: path of the CSV file
+    :param usecols: optional list of columns to load (defaults to all the schema columns)
+    :param parse_dates: whether to parse the date columns into datetime64. The inference pipeline parses the
+                        dates itself, so steps feeding the model keep them as strings
+    :param engine: "arrow", "c" (pandas) or "auto" (arrow if pyarrow is installed and no kwargs are given)
+    :param kwargs: additional arguments for pd.read_csv (only supported by the pandas engine)
+    :return: a DataFrame
+    """
+    columns = _projection(usecols)
+    if engine == "arrow" or (engine == "auto" and pa is not None and not kwargs):
+        read_options, parse_options, convert_options = _arrow_options(columns, parse_dates)
+        table = pa_csv.read_csv(
+            path, read_options=read_options, parse_options=parse_options, convert_options=convert_options
+        )
+        return _to_pandas(table)
+
+    return pd.read_csv(
+        path,
+        usecols=usecols,
+        dtype=dtypes_for(columns),
+        parse_dates=[c for c in DATE_COLUMNS if c in columns] if parse_dates else False,
+        **kwargs,
+    )
+
+
+def iter_csv(path, chunk_size, usecols=None, parse_dates=True):
+    """
+    Read a dataset in chunks of about chunk_size rows, with the schema dtypes (see read_csv)
+
+    :param path: path of the CSV file
+    :param chunk_size: number of rows per chunk (with pyarrow, chunks are made of whole parse blocks)
+    :param usecols: optional list of columns to load
+    :param parse_dates: whether to parse the date columns into datetime64
+    :return: an iterator of DataFrames
+    """
+    if pa is None:
+        yield from read_csv(path, usecols=usecols, parse_dates=parse_dates, engine="c", chunksize=chunk_size)
+        return
+
+    read_options, parse_options, convert_options = _arrow_options(_projection(usecols), parse_dates)
+    reader = pa_csv.open_csv(
+        path, read_options=read_options, parse_options=parse_options, convert_options=convert_options
+    )
+    batches, n_rows = [], 0
+    for batch in reader:
+        batches.append(batch)
+        n_rows += batch.num_rows
+        if n_rows >= chunk_size:
+            yield _to_pandas(pa.Table.from_batches(batches))
+            batches, n_rows = [], 0
+    if batches:
+        yield _to_pandas(pa.Table.from_batches(batches))
+
+
+def read_columns(path):
+    """
+    Read only the header of a CSV file
+
+    :param path: path of the CSV file
+    :return: list of the column names
+    """
+    return list(pd.read_csv(path, nrows=0).columns)
+
+
+def apply_schema(df):
+    """
+    Cast the columns of a DataFrame to the schema dtypes
+
+    :param df: a DataFrame with (a subset of) the schema columns
+    :return: the DataFrame with the schema dtypes
+    """
+    return df.astype(dtypes_for(df.columns))
+
+
+def to_plain_dtypes(df):
+    """
+    Convert categorical columns back to object, for consumers (e.g. MLflow signature inference) that do
+    not support the pandas categorical dtype
+
+    :param df: a DataFrame
+    :return: the DataFrame with categorical columns converted to object
+    """
+    return df.astype({c: "object" for c in df.columns if isinstance(df[c].dtype, pd.CategoricalDtype)})
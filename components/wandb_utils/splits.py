@@ -0,0 +1,118 @@
+import os
+import tempfile
+from functools import partial
+
+import numpy as np
+import wandb
+
+from wandb_utils.partitions import dataset_digest, dataset_path, read_dataset
+
+
+# Parsed source datasets, keyed by local path and loaded columns, so that several splits of the same source
+# (e.g. train and validation) share a single parse of the file
+_source_cache = {}
+
+
+class SplitIndex:
+    """
+    A split of a dataset represented only by the (sorted) positions of its rows inside the source dataset,
+    plus a reference to the source artifact and the digest of the source dataset. The rows are materialized
+    lazily with a single take from the parsed source
+    """
+
+    def __init__(self, index, source, source_digest):
+        self.index = np.sort(np.asarray(index, dtype=np.int64))
+        self.source = source
+        self.source_digest = source_digest
+
+    def __len__(self):
+        return self.index.shape[0]
+
+    def save(self, path):
+        """
+        Save the split as a compressed .npz file
+        """
+        np.savez_compressed(
+            path, index=self.index, source=np.array(self.source), source_digest=np.array(self.source_digest)
+        )
+
+    @classmethod
+    def load(cls, path):
+        """
+        Load a split previously saved with `save`
+        """
+        with np.load(path) as data:
+            return cls(data["index"], str(data["source"]), str(data["source_digest"]))
+
+    def subset(self, positions):
+        """
+        Return a new split containing the rows at the given positions of this split
+
+        :param positions: positions relative to this split (not to the source)
+        """
+        return SplitIndex(self.index[positions], self.source, self.source_digest)
+
+    def materialize(self, wandb_run, read_fn=None, usecols=None):
+        """
+        Fetch the source artifact (once per process), check that it is the same dataset the split was
+        computed on and return the rows of this split
+
+        :param wandb_run: current Weights & Biases run
+        :param read_fn: function used to parse the source dataset into a DataFrame. Defaults to read_dataset,
+                        leaving the dates unparsed as expected by the inference pipeline
+        :param usecols: optional list of the columns the step needs, the others are not parsed
+        :return: a DataFrame with the rows of the split, in source order
+        """
+        source_path = dataset_path(wandb_run.use_artifact(self.source))
+        key = (source_path, None if usecols is None else tuple(usecols))
+        if key not in _source_cache:
+            if not any(cached_path == source_path for cached_path, _ in _source_cache):
+                digest = dataset_digest(source_path)
+                if digest != self.source_digest:
+                    raise ValueError(
+                        f"Source artifact {self.source} has digest {digest}, "
+                        f"but the split was computed on {self.source_digest}"
+                    )
+            read_kwargs = {} if usecols is None else {"usecols": usecols}
+            _source_cache[key] = (read_fn or partial(read_dataset, parse_dates=False))(source_path, **read_kwargs)
+
+        return _source_cache[key].take(self.index).reset_index(drop=True)
+
+
+def log_split(split, artifact_name, artifact_type, artifact_description, wandb_run, aliases=None):
+    """
+    Log a split as a W&B artifact containing only its row index
+
+    :param split: the SplitIndex to log
+    :param artifact_name: name for the artifact
+    :param artifact_type: type for the artifact
+    :param artifact_description: a brief description of the artifact
+    :param wandb_run: current Weights & Biases run
+    :param aliases: optional list of aliases for the artifact
+    :return: None
+    """
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, f"{artifact_name}.npz")
+        split.save(path)
+
+        artifact = wandb.Artifact(
+            artifact_name,
+            type=artifact_type,
+            description=artifact_description,
+            metadata={"source": split.source, "source_digest": split.source_digest, "n_rows": len(split)},
+        )
+        artifact.add_file(path)
+        wandb_run.log_artifact(artifact, aliases=aliases)
+        # The file is deleted with the temporary directory, so wait for the upload to finish
+        artifact.wait()
+
+
+def use_split(wandb_run, artifact_name):
+    """
+    Fetch a split artifact logged with `log_split`
+
+    :param wandb_run: current Weights & Biases run
+    :param artifact_name: name (and version/alias) of the split artifact
+    :return: the SplitIndex
+    """
+    return SplitIndex.load(wandb_run.use_artifact(artifact_name).file())
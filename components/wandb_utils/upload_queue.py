@@ -0,0 +1,143 @@
+import atexit
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import wandb
+
+from wandb_utils.chunked_artifact import build_chunked_artifact
+
+
+logger = logging.getLogger(__name__)
+
+
+def _path_size(path):
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    return sum(
+        os.path.getsize(os.path.join(root, f)) for root, _, files in os.walk(path) for f in files
+    )
+
+
+class UploadQueue:
+    """
+    Log W&B artifacts on a background worker, so that the step can keep computing while large files are
+    hashed and uploaded. The queue is drained (waiting for all the uploads, with retries) when the run is
+    finished, or at interpreter exit if the run is never finished explicitly
+    """
+
+    def __init__(self, wandb_run, max_workers=1, max_retries=3, retry_wait=5.0, report_every=10.0):
+        """
+        :param wandb_run: current Weights & Biases run
+        :param max_workers: number of uploads running concurrently
+        :param max_retries: number of attempts after the first failure of an upload
+        :param retry_wait: seconds to wait before the first retry (doubled at every attempt)
+        :param report_every: seconds between progress reports while draining
+        """
+        self.wandb_run = wandb_run
+        self.max_retries = max_retries
+        self.retry_wait = retry_wait
+        self.report_every = report_every
+
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="wandb-upload")
+        self._jobs = []
+
+        # Make sure everything is uploaded before the run is closed
+        self._run_finish = wandb_run.finish
+        wandb_run.finish = self._finish_run
+        atexit.register(self.drain)
+
+    def submit(self, artifact_name, artifact_type, artifact_description, path, metadata=None, aliases=None,
+               chunked=False):
+        """
+        Queue the file or directory at path for upload as a W&B artifact. The path must not be modified or
+        removed until the queue has been drained
+
+        :param artifact_name: name for the artifact
+        :param artifact_type: type for the artifact
+        :param artifact_description: a brief description of the artifact
+        :param path: local file or directory to upload
+        :param metadata: optional dictionary of metadata for the artifact
+        :param aliases: optional list of aliases for the artifact
+        :param chunked: upload as a chunked, deduplicated artifact (see wandb_utils.chunked_artifact)
+        :return: a Future resolving to the logged artifact
+        """
+        size = _path_size(path)
+        logger.info(f"Queueing upload of {path} ({size / 1e6:.1f} MB) as {artifact_name}")
+        future = self._executor.submit(
+            self._upload, artifact_name, artifact_type, artifact_description, path, metadata, aliases, chunked
+        )
+        self._jobs.append((artifact_name, size, future))
+        return future
+
+    def _upload(self, artifact_name, artifact_type, artifact_description, path, metadata, aliases, chunked):
+        artifact = None
+        for attempt in range(self.max_retries + 1):
+            try:
+                # Once the artifact is logged, only the wait is retried: logging it again would create a
+                # duplicate version
+                if artifact is None:
+                    artifact = self._log(
+                        artifact_name, artifact_type, artifact_description, path, metadata, aliases, chunked
+                    )
+                artifact.wait()
+                return artifact
+            except Exception as e:
+                if attempt == self.max_retries:
+                    raise
+                delay = self.retry_wait * 2 ** attempt
+                step = "Upload" if artifact is None else "Wait for the upload"
+                logger.warning(f"{step} of {artifact_name} failed ({e}), retrying in {delay:.1f}s")
+                time.sleep(delay)
+
+    def _log(self, artifact_name, artifact_type, artifact_description, path, metadata, aliases, chunked):
+        if chunked:
+            artifact = build_chunked_artifact(artifact_name, artifact_type, artifact_description, path, metadata)
+        else:
+            artifact = wandb.Artifact(
+                artifact_name,
+                type=artifact_type,
+                description=artifact_description,
+                metadata=metadata,
+            )
+            if os.path.isdir(path):
+                artifact.add_dir(path)
+            else:
+                artifact.add_file(path)
+        self.wandb_run.log_artifact(artifact, aliases=aliases)
+        return artifact
+
+    def drain(self):
+        """
+        Wait for all the queued uploads to complete, reporting progress
+
+        :raise RuntimeError: if one or more uploads failed after all the retries
+        """
+        pending = [future for _, _, future in self._jobs]
+        total_bytes = sum(size for _, size, _ in self._jobs)
+        while pending:
+            _, not_done = wait(pending, timeout=self.report_every)
+            if not_done:
+                done_bytes = sum(size for _, size, future in self._jobs if future.done())
+                logger.info(
+                    f"Waiting for uploads: {len(self._jobs) - len(not_done)}/{len(self._jobs)} artifacts, "
+                    f"{done_bytes / 1e6:.1f}/{total_bytes / 1e6:.1f} MB"
+                )
+            pending = list(not_done)
+
+        failed = [(name, future.exception()) for name, _, future in self._jobs if future.exception()]
+        self._jobs = []
+        for name, e in failed:
+            logger.error(f"Upload of {name} failed: {e}")
+        if failed:
+            raise RuntimeError(f"{len(failed)} artifact upload(s) failed")
+
+    def _finish_run(self, *args, **kwargs):
+        try:
+            self.drain()
+        finally:
+            self._executor.shutdown(wait=True)
+            self.wandb_run.finish = self._run_finish
+            atexit.unregister(self.drain)
+            self._run_finish(*args, **kwargs)
@@ -0,0 +1,413 @@
+"""
+Pool of conda environments for the pipeline steps.
+
+mlflow creates one environment per distinct conda.yml (mlflow-<sha1 of the file>), so every component
+spec, and every edit to one, costs a multi-GB environment and minutes of solving. The pool instead:
+
+- normalizes the component specs (package names, pins, relative editable paths) and merges the compatible
+  ones (same pins wherever they overlap) into a few shared specs;
+- names each environment by the content hash of its merged spec, and reuses any pool environment whose
+  installed packages satisfy a step's spec;
+- builds the missing environments in parallel ahead of a run (`python env_pool.py prebuild`);
+- evicts the least recently used environments, pool or mlflow-*, above a disk budget, except the ones a
+  warm worker is running in (`python env_pool.py prune --budget_gb 20`).
+"""
+import argparse
+import glob
+import hashlib
+import json
+import logging
+import os
+import re
+import subprocess
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+STEP_SPECS = ["src/*/conda.yml", "components/*/conda.yml"]
+ENV_PREFIX = "nyc_airbnb-"
+# Stored in the conda-meta directory of every pool environment
+METADATA_NAME = "nyc_airbnb_env_pool.json"
+# Environments that may be evicted by prune
+EVICTABLE_PREFIXES = (ENV_PREFIX, "mlflow-")
+
+_REQUIREMENT = re.compile(r"^\s*([A-Za-z0-9_.\-\[\]]+)\s*(==|=|>=|<=|!=|~=|>|<)?\s*([^\s;#]*)")
+
+
+def _package_name(name):
+    return re.sub(r"[-_.]+", "-", name).lower()
+
+
+def _parse_requirement(requirement):
+    """
+    Split a conda or pip requirement into (name, (operator, version)), with (None, None) for unpinned ones
+    """
+    match = _REQUIREMENT.match(requirement)
+    if match is None:
+        raise ValueError(f"Cannot parse requirement {requirement}")
+    name, operator, version = match.groups()
+    return _package_name(name), (operator, version) if operator else (None, None)
+
+
+def normalize_spec(path):
+    """
+    Load a conda.yml into a canonical form, independent of the formatting and of the directory it is in
+
+    :param path: path of the conda.yml
+    :return: dictionary with the channels, the conda and pip pins ({name: [operator, version]}) and the
+             direct (editable or URL) pip requirements, with editable paths made absolute
+    """
+    import yaml
+
+    with open(path) as fp:
+        raw = yaml.safe_load(fp)
+
+    spec = {"channels": list(raw.get("channels") or []), "conda": {}, "pip": {}, "direct": []}
+    for dependency in raw.get("dependencies") or []:
+        if isinstance(dependency, dict):
+            for requirement in dependency.get("pip") or []:
+                if requirement.startswith("-e"):
+                    target = requirement[2:].strip()
+                    spec["direct"].append(f"-e {os.path.normpath(os.path.join(os.path.dirname(path), target))}")
+                elif "://" in requirement:
+                    spec["direct"].append(requirement)
+                else:
+                    name, pin = _parse_requirement(requirement)
+                    spec["pip"][name] = list(pin)
+        else:
+            name, pin = _parse_requirement(dependency)
+            spec["conda"][name] = list(pin)
+    spec["direct"] = sorted(set(spec["direct"]))
+    return spec
+
+
+def spec_hash(spec):
+    return hashlib.sha1(json.dumps(spec, sort_keys=True).encode()).hexdigest()
+
+
+def _merge_pin(a, b):
+    """
+    Merge two pins of the same package, or return None if they conflict. A fuzzy conda pin (=3.10) is
+    compatible with a more specific one (=3.10.0)
+    """
+    if a[0] is None:
+        return b
+    if b[0] is None or a == b:
+        return a
+    if a[0] == "=" and b[0] in ("=", "==") and (b[1] + ".").startswith(a[1] + "."):
+        return b
+    if b[0] == "=" and a[0] in ("=", "==") and (a[1] + ".").startswith(b[1] + "."):
+        return a
+    return None
+
+
+def merge_specs(a, b):
+    """
+    Merge two normalized specs into one environment, or return None if they are not compatible
+
+    :return: the merged spec, or None
+    """
+    # Direct requirements (e.g. the local wandb-utils vs the one from git) cannot be compared by version
+    if not (set(a["direct"]) <= set(b["direct"]) or set(b["direct"]) <= set(a["direct"])):
+        return None
+    merged = {
+        "channels": list(dict.fromkeys(a["channels"] + b["channels"])),
+        "direct": sorted(set(a["direct"]) | set(b["direct"])),
+    }
+    for kind in ("conda", "pip"):
+        merged[kind] = dict(a[kind])
+        for name, pin in b[kind].items():
+            merged_pin = _merge_pin(merged[kind].get(name, [None, None]), pin)
+            if merged_pin is None:
+                return None
+            merged[kind][name] = list(merged_pin)
+    return merged
+
+
+def group_specs(specs):
+    """
+    Greedily group the step specs into as few compatible merged specs as possible
+
+    :param specs: dictionary of normalized specs, keyed by step
+    :return: list of (merged spec, list of steps)
+    """
+    groups = []
+    # The largest specs first, so that the small ones are merged into them
+    for step in sorted(specs, key=lambda s: -(len(specs[s]["conda"]) + len(specs[s]["pip"]))):
+        for i, (merged, steps) in enumerate(groups):
+            candidate = merge_specs(merged, specs[step])
+            if candidate is not None:
+                groups[i] = (candidate, steps + [step])
+                break
+        else:
+            groups.append((specs[step], [step]))
+    return groups
+
+
+def _pin_satisfied(pin, installed):
+    operator, version = pin
+    if operator is None:
+        return True
+    if operator == "=":
+        return (installed + ".").startswith(version + ".")
+    if operator == "==":
+        return installed == version
+    from packaging.specifiers import SpecifierSet
+
+    return SpecifierSet(f"{operator}{version}").contains(installed, prereleases=True)
+
+
+def to_conda_yml(spec, name):
+    """
+    Render a normalized spec as a conda environment file
+    """
+    def requirement(package, pin, pip):
+        operator, version = pin
+        if operator is None:
+            return package
+        return f"{package}{'==' if pip and operator == '=' else operator}{version}"
+
+    pip = [requirement(p, pin, True) for p, pin in sorted(spec["pip"].items())] + spec["direct"]
+    dependencies = [requirement(p, pin, False) for p, pin in sorted(spec["conda"].items())]
+    if pip:
+        dependencies.append({"pip": pip})
+    return {"name": name, "channels": spec["channels"], "dependencies": dependencies}
+
+
+class EnvPool:
+    """
+    Conda environments shared by the pipeline steps
+    """
+
+    def __init__(self, root=ROOT, spec_patterns=STEP_SPECS, max_workers=4):
+        """
+        :param root: root of the repository
+        :param spec_patterns: glob patterns (relative to root) of the step conda.yml files
+        :param max_workers: number of environments built concurrently
+        """
+        self.root = root
+        self.spec_patterns = spec_patterns
+        self.max_workers = max_workers
+        self._envs = None
+        # create runs concurrently in prebuild, and refreshes the cached environment list
+        self._envs_lock = threading.Lock()
+
+    def step_specs(self):
+        """
+        Normalized specs of all the steps, keyed by step directory
+        """
+        paths = sorted(p for pattern in self.spec_patterns for p in glob.glob(os.path.join(self.root, pattern)))
+        return {os.path.dirname(p): normalize_spec(p) for p in paths}
+
+    def envs(self):
+        """
+        Existing conda environments, as a dictionary of prefix keyed by name
+        """
+        with self._envs_lock:
+            if self._envs is None:
+                output = subprocess.run(["conda", "env", "list", "--json"], capture_output=True, check=True).stdout
+                self._envs = {os.path.basename(p): p for p in json.loads(output)["envs"]}
+            return self._envs
+
+    def _refresh_envs(self):
+        with self._envs_lock:
+            self._envs = None
+        return self.envs()
+
+    def _metadata(self, prefix):
+        path = os.path.join(prefix, "conda-meta", METADATA_NAME)
+        if not os.path.exists(path):
+            return None
+        with open(path) as fp:
+            return json.load(fp)
+
+    def _touch(self, prefix):
+        metadata = self._metadata(prefix)
+        metadata["last_used"] = time.time()
+        with open(os.path.join(prefix, "conda-meta", METADATA_NAME), "w") as fp:
+            json.dump(metadata, fp)
+
+    def _installed(self, name):
+        output = subprocess.run(["conda", "list", "-n", name, "--json"], capture_output=True, check=True).stdout
+        return {_package_name(p["name"]): p["version"] for p in json.loads(output)}
+
+    def satisfies(self, name, spec):
+        """
+        Whether the installed packages of a pool environment satisfy a spec
+        """
+        metadata = self._metadata(self.envs()[name])
+        if metadata is None or not set(spec["direct"]) <= set(metadata["spec"]["direct"]):
+            return False
+        installed = self._installed(name)
+        return all(
+            package in installed and _pin_satisfied(pin, installed[package])
+            for kind in ("conda", "pip")
+            for package, pin in spec[kind].items()
+        )
+
+    def create(self, spec):
+        """
+        Create the environment of a merged spec (if it does not exist yet)
+
+        :return: the name of the environment
+        """
+        name = ENV_PREFIX + spec_hash(spec)[:16]
+        if name in self.envs():
+            return name
+
+        import yaml
+
+        logger.info(f"Creating environment {name}")
+        with tempfile.NamedTemporaryFile("w", suffix=".yml", delete=False) as fp:
+            yaml.safe_dump(to_conda_yml(spec, name), fp)
+        try:
+            subprocess.run(["conda", "env", "create", "-q", "-f", fp.name], check=True)
+        finally:
+            os.unlink(fp.name)
+
+        with open(os.path.join(self._refresh_envs()[name], "conda-meta", METADATA_NAME), "w") as fp:
+            json.dump({"spec": spec, "last_used": time.time()}, fp)
+        return name
+
+    def resolve(self, project_dir):
+        """
+        Return the name of an environment for a step, reusing an existing pool environment when one
+        satisfies the step's spec, and creating the environment of the step's group otherwise
+
+        :param project_dir: directory of the step (containing its conda.yml)
+        :return: the name of the environment
+        """
+        project_dir = os.path.abspath(project_dir)
+        spec = normalize_spec(os.path.join(project_dir, "conda.yml"))
+
+        # Most recently used first, so the steps of a run converge on the same environments
+        candidates = sorted(
+            (n for n in self.envs() if n.startswith(ENV_PREFIX) and self._metadata(self.envs()[n])),
+            key=lambda n: -self._metadata(self.envs()[n])["last_used"],
+        )
+        for name in candidates:
+            if self.satisfies(name, spec):
+                self._touch(self.envs()[name])
+                return name
+
+        specs = self.step_specs()
+        specs[project_dir] = spec
+        merged = next(m for m, steps in group_specs(specs) if project_dir in steps)
+        return self.create(merged)
+
+    def prebuild(self):
+        """
+        Build the environments of all the step groups in parallel
+
+        :return: dictionary of environment name, keyed by step directory
+        """
+        groups = group_specs(self.step_specs())
+        self.envs()
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            names = list(executor.map(lambda group: self.create(group[0]), groups))
+        for name, (_, steps) in zip(names, groups):
+            logger.info(f"{name}: {', '.join(os.path.relpath(s, self.root) for s in steps)}")
+        return {step: name for name, (_, steps) in zip(names, groups) for step in steps}
+
+    def _last_used(self, prefix):
+        metadata = self._metadata(prefix)
+        if metadata is not None:
+            return metadata["last_used"]
+        history = os.path.join(prefix, "conda-meta", "history")
+        return os.path.getmtime(history) if os.path.exists(history) else 0.0
+
+    @staticmethod
+    def _disk_usage(prefix):
+        # Files hardlinked from the package cache are not freed by removing the environment, so they are
+        # not counted
+        total = 0
+        for directory, _, files in os.walk(prefix):
+            for f in files:
+                stat = os.lstat(os.path.join(directory, f))
+                if stat.st_nlink == 1:
+                    total += stat.st_blocks * 512
+        return total
+
+    def prune(self, budget_bytes, dry_run=False, socket_dir=None):
+        """
+        Remove the least recently used pool and mlflow environments until their disk usage fits the budget.
+        The active environment and the environments of live warm workers are never removed
+
+        :param budget_bytes: disk budget of the evictable environments
+        :param dry_run: only report the environments that would be removed
+        :param socket_dir: optional socket directory of the warm workers (see worker_pool.py)
+        :return: list of the removed environments
+        """
+        from worker_pool import worker_alive
+
+        in_use = {os.environ.get("CONDA_DEFAULT_ENV")}
+        if socket_dir is not None:
+            in_use |= {n for n in self.envs() if worker_alive(socket_dir, n)}
+        evictable = {n: p for n, p in self.envs().items() if n.startswith(EVICTABLE_PREFIXES) and n not in in_use}
+        usage = {n: self._disk_usage(p) for n, p in evictable.items()}
+        total = sum(usage.values())
+        logger.info(f"{len(evictable)} environments use {total / 1e9:.1f} GB (budget {budget_bytes / 1e9:.1f} GB)")
+
+        removed = []
+        for name in sorted(evictable, key=lambda n: self._last_used(evictable[n])):
+            if total <= budget_bytes:
+                break
+            logger.info(f"Removing {name} ({usage[name] / 1e9:.1f} GB)")
+            if not dry_run:
+                subprocess.run(["conda", "env", "remove", "-q", "-n", name], check=True)
+            total -= usage[name]
+            removed.append(name)
+        self._refresh_envs()
+        return removed
+
+    def run(self, uri, entry_point="main", parameters=None):
+        """
+        Run a step in its pool environment, as mlflow.run would in the mlflow-<hash> one. The command of the
+        entry point can be any command (e.g. the pytest of data_check), not only a python script
+
+        :param uri: local directory of the MLflow project
+        :param entry_point: entry point of the project
+        :param parameters: dictionary of parameters of the entry point
+        """
+        from worker_pool import render_command
+
+        argv = render_command(uri, entry_point, parameters or {})
+        subprocess.run(
+            ["conda", "run", "--no-capture-output", "-n", self.resolve(uri)] + argv,
+            cwd=os.path.abspath(uri),
+            check=True,
+        )
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)-15s %(message)s")
+    parser = argparse.ArgumentParser(description="Manage the conda environments of the pipeline steps")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    prebuild_parser = subparsers.add_parser("prebuild", help="Build the environments of all the steps")
+    prebuild_parser.add_argument("--max_workers", type=int, default=4, help="Environments built concurrently")
+
+    prune_parser = subparsers.add_parser("prune", help="Remove least recently used environments")
+    prune_parser.add_argument("--budget_gb", type=float, required=True, help="Disk budget in GB")
+    prune_parser.add_argument("--dry_run", action="store_true", help="Only list the environments to remove")
+    prune_parser.add_argument(
+        "--socket_dir",
+        type=str,
+        default="~/.cache/nyc_airbnb/workers",
+        help="Socket directory of the warm workers, whose environments are kept",
+    )
+
+    subparsers.add_parser("plan", help="Show how the step specs are grouped into environments")
+
+    args = parser.parse_args()
+    if args.command == "prebuild":
+        EnvPool(max_workers=args.max_workers).prebuild()
+    elif args.command == "prune":
+        EnvPool().prune(args.budget_gb * 1e9, dry_run=args.dry_run, socket_dir=os.path.expanduser(args.socket_dir))
+    else:
+        for merged, steps in group_specs(EnvPool().step_specs()):
+            print(f"{ENV_PREFIX}{spec_hash(merged)[:16]}: {', '.join(os.path.relpath(s, ROOT) for s in steps)}")
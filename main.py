@@ -3,9 +3,12 @@ import mlflow
 import tempfile
 import json
 import hydra
-from omegaconf import DictConfig
+from omegaconf import DictConfig, OmegaConf
 import logging
 
+from env_pool import EnvPool
+from worker_pool import WorkerPool
+
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -17,9 +20,23 @@ _steps = [
     "data_check",
     "data_split",
     "train_random_forest",
+    "promote_model",
     "test_regression_model",  # Added the new step to the pipeline
 ]
 
+def run_step(pool, envs, uri, entry_point, parameters):
+    """
+    Runs a local pipeline step, on its warm worker if the worker pool is enabled, in a shared environment if
+    the environment pool is enabled, and with mlflow.run otherwise.
+    """
+    if pool is not None:
+        pool.run(uri=uri, entry_point=entry_point, parameters=parameters)
+    elif envs is not None:
+        envs.run(uri=uri, entry_point=entry_point, parameters=parameters)
+    else:
+        mlflow.run(uri=uri, entry_point=entry_point, parameters=parameters)
+
+
 @hydra.main(config_name="config", config_path=".", version_base="1.2")
 def go(config: DictConfig):
     """
@@ -38,6 +55,23 @@ def go(config: DictConfig):
         )
         logger.info(f"Steps to execute: {steps_to_execute}")
 
+        # Optional pool of conda environments shared by the steps, built ahead of the run
+        envs = None
+        if config["main"]["env_pool"]["enabled"]:
+            envs = EnvPool(root=hydra.utils.get_original_cwd(), max_workers=config["main"]["env_pool"]["max_workers"])
+            if config["main"]["env_pool"]["prebuild"]:
+                envs.prebuild()
+
+        # Optional pool of long-lived workers (one per step conda env) that keep the imports hot across runs
+        pool = None
+        if config["main"]["warm_workers"]["enabled"]:
+            pool = WorkerPool(
+                os.path.expanduser(config["main"]["warm_workers"]["socket_dir"]),
+                max_jobs=config["main"]["warm_workers"]["max_jobs"],
+                idle_timeout=config["main"]["warm_workers"]["idle_timeout"],
+                env_pool=envs,
+            )
+
         with tempfile.TemporaryDirectory() as tmp_dir:
             if "download" in steps_to_execute:
                 logger.info("Running 'download' step")
@@ -52,10 +86,32 @@ def go(config: DictConfig):
                     },
                 )
 
+            # Not part of "all": run it explicitly, e.g. main.steps=download,eda
+            if "eda" in steps_to_execute:
+                logger.info("Running 'eda' step")
+                run_step(
+                    pool,
+                    envs,
+                    uri=os.path.join(hydra.utils.get_original_cwd(), "src", "eda"),
+                    entry_point="profile",
+                    parameters={
+                        "input_artifact": "sample.csv:latest",
+                        "output_artifact": "sample_profile",
+                        "chunk_size": config["eda"]["chunk_size"],
+                        "sample_size": config["eda"]["sample_size"],
+                        "top_k": config["eda"]["top_k"],
+                    },
+                )
+
             if "basic_cleaning" in steps_to_execute:
                 logger.info("Running 'basic_cleaning' step")
                 logger.info(f"min_price: {config['etl']['min_price']}, max_price: {config['etl']['max_price']}")
-                mlflow.run(
+                bounds_config_path = os.path.abspath("bounds_config.json")
+                with open(bounds_config_path, "w") as fp:
+                    json.dump(OmegaConf.to_container(config["etl"]["adaptive_bounds"]), fp)
+                run_step(
+                    pool,
+                    envs,
                     uri=os.path.join(hydra.utils.get_original_cwd(), "src", "basic_cleaning"),
                     entry_point="main",
                     parameters={
@@ -65,12 +121,16 @@ def go(config: DictConfig):
                         "output_description": "Cleaned dataset with outliers removed",
                         "min_price": config["etl"]["min_price"],
                         "max_price": config["etl"]["max_price"],
+                        "incremental": config["etl"]["incremental"],
+                        "bounds_config": bounds_config_path,
                     },
                 )
 
             if "data_check" in steps_to_execute:
                 logger.info("Running 'data_check' step")
-                mlflow.run(
+                run_step(
+                    pool,
+                    envs,
                     uri=os.path.join(hydra.utils.get_original_cwd(), "src", "data_check"),
                     entry_point="main",
                     parameters={
@@ -84,8 +144,10 @@ def go(config: DictConfig):
 
             if "data_split" in steps_to_execute:
                 logger.info("Running 'data_split' step")
-                mlflow.run(
-                    uri=f"{config['main']['components_repository']}#train_val_test_split",
+                run_step(
+                    pool,
+                    envs,
+                    uri=os.path.join(hydra.utils.get_original_cwd(), "components", "train_val_test_split"),
                     entry_point="main",
                     parameters={
                         "input": "clean_sample1.csv:reference",
@@ -101,32 +163,93 @@ def go(config: DictConfig):
                 with open(rf_config_path, "w") as fp:
                     json.dump(dict(config["modeling"]["random_forest"]), fp)
 
-                mlflow.run(
+                spatial_config_path = os.path.abspath("spatial_config.json")
+                with open(spatial_config_path, "w") as fp:
+                    json.dump(OmegaConf.to_container(config["modeling"]["spatial_features"]), fp)
+
+                run_step(
+                    pool,
+                    envs,
                     uri=os.path.join(hydra.utils.get_original_cwd(), "src", "train_random_forest"),
                     entry_point="main",
                     parameters={
-                        "trainval_artifact": "trainval_data.csv:latest",
+                        "trainval_artifact": "trainval_split:latest",
                         "val_size": config["modeling"]["val_size"],
+                        "cv_folds": config["modeling"]["cv_folds"],
+                        "importance_repeats": config["modeling"]["importance_repeats"],
+                        "importance_max_rows": config["modeling"]["importance_max_rows"],
                         "random_seed": config["modeling"]["random_seed"],
                         "stratify_by": config["modeling"]["stratify_by"],
                         "rf_config": rf_config_path,
+                        "spatial_config": spatial_config_path,
                         "max_tfidf_features": config["modeling"]["max_tfidf_features"],
+                        "text_features": config["modeling"]["text_features"],
+                        "hashing_features": config["modeling"]["hashing_features"],
+                        "hashing_use_idf": config["modeling"]["hashing_use_idf"],
+                        "output_artifact": config["modeling"]["output_artifact"],
+                        "feature_store_dir": config["modeling"]["feature_store_dir"],
+                    },
+                )
+
+            # Not part of "all": run it explicitly, e.g. main.steps=basic_cleaning,refresh_random_forest
+            if "refresh_random_forest" in steps_to_execute:
+                logger.info("Running 'refresh_random_forest' step")
+                run_step(
+                    pool,
+                    envs,
+                    uri=os.path.join(hydra.utils.get_original_cwd(), "src", "train_random_forest"),
+                    entry_point="refresh",
+                    parameters={
+                        "mlflow_model": "random_forest_export:prod",
+                        "new_data": "clean_sample1.csv:latest",
+                        "test_artifact": "test_split:latest",
+                        "n_new_trees": config["modeling"]["refresh"]["n_new_trees"],
+                        "retire_oldest": config["modeling"]["refresh"]["retire_oldest"],
                         "output_artifact": config["modeling"]["output_artifact"],
                     },
                 )
 
+            if "promote_model" in steps_to_execute:
+                logger.info("Running 'promote_model' step")
+                run_step(
+                    pool,
+                    envs,
+                    uri=os.path.join(hydra.utils.get_original_cwd(), "components", "promote_model"),
+                    entry_point="main",
+                    parameters={
+                        "champion": "random_forest_export:prod",
+                        "candidates": config["modeling"]["promotion"]["candidates"],
+                        "test_dataset": "test_split:latest",
+                        "metric": config["modeling"]["promotion"]["metric"],
+                        "min_improvement": config["modeling"]["promotion"]["min_improvement"],
+                        "max_latency_ratio": config["modeling"]["promotion"]["max_latency_ratio"],
+                        "n_parallel": config["modeling"]["promotion"]["n_parallel"],
+                        "dry_run": config["modeling"]["promotion"]["dry_run"],
+                    },
+                )
+
             if "test_regression_model" in steps_to_execute:
                 logger.info("Running 'test_regression_model' step")
-                mlflow.run(
+                run_step(
+                    pool,
+                    envs,
                     uri=os.path.join(hydra.utils.get_original_cwd(), "components", "test_regression_model"),
                     entry_point="main",
                     parameters={
                         "mlflow_model": "random_forest_export:prod",
-                        "test_dataset": "test_data.csv:latest",
+                        "test_dataset": "test_split:latest",
+                        "prediction_cache_dir": config["modeling"]["prediction_cache_dir"],
+                        "feature_store_dir": config["modeling"]["feature_store_dir"],
                     },
                 )
                 logger.info("Completed 'test_regression_model' step")
 
+        if envs is not None and config["main"]["env_pool"]["budget_gb"]:
+            envs.prune(
+                config["main"]["env_pool"]["budget_gb"] * 1e9,
+                socket_dir=os.path.expanduser(config["main"]["warm_workers"]["socket_dir"]),
+            )
+
     except Exception as e:
         logger.error(f"Pipeline execution failed: {e}")
         raise
@@ -3,14 +3,33 @@
 Basic cleaning script for the Airbnb dataset.
 """
 import argparse
+import json
 import logging
+import os
+import shutil
 import wandb
 import pandas as pd
+from wandb_utils.chunked_artifact import log_chunked_artifact
+from wandb_utils.partitions import PARTITIONS_DIR, Watermark, dataset_digest, dataset_path, is_partitioned
+from wandb_utils.quantile_sketch import KLLSketch, quantile_bounds, sketch_columns
+from wandb_utils.schema import NYC_BOUNDS, iter_csv, read_csv
 
 # Logging setup
 logging.basicConfig(level=logging.INFO, format="%(asctime)-15s %(message)s")
 logger = logging.getLogger()
 
+# Sketches and bounds carried over between versions of a partitioned dataset
+BOUNDS_NAME = "bounds.json"
+
+
+def fixed_bounds(min_price, max_price):
+    """
+    Bounds of the default cleaning: the configured price range and the New York City box
+
+    :return: dictionary of (lower, upper), keyed by column
+    """
+    return {"price": (min_price, max_price), **NYC_BOUNDS}
+
 
 def clean_data(input_path, min_price, max_price):
     """
@@ -25,26 +44,166 @@ def clean_data(input_path, min_price, max_price):
         pd.DataFrame: Cleaned DataFrame.
     """
     logger.info(f"Loading dataset from {input_path}")
-    df = pd.read_csv(input_path)
+    df = read_csv(input_path)
+
+    return clean_frame(df, fixed_bounds(min_price, max_price))
 
-    # Filter rows based on price
-    logger.info(f"Filtering rows with price between {min_price} and {max_price}")
-    df = df[df["price"].between(min_price, max_price)].copy()
+
+def clean_frame(df, bounds):
+    """
+    Applies the range filters to a DataFrame.
+
+    Args:
+        df (pd.DataFrame): Raw rows to clean.
+        bounds (dict): (lower, upper) bounds, keyed by column. Rows with a missing or out of range value in
+            any of these columns are dropped.
+
+    Returns:
+        pd.DataFrame: Cleaned DataFrame.
+    """
+    keep = pd.Series(True, index=df.index)
+    for column, (lower, upper) in bounds.items():
+        logger.info(f"Filtering rows with {column} between {lower} and {upper}")
+        keep &= df[column].between(lower, upper).fillna(False)
+    df = df[keep].copy()
 
     # Convert last_review to datetime
     logger.info("Converting 'last_review' column to datetime format")
     df["last_review"] = pd.to_datetime(df["last_review"], errors="coerce")
 
-    # Remove invalid geolocations
-    logger.info("Filtering rows with valid longitude and latitude ranges")
-    df = df[
-        df["longitude"].between(-74.25, -73.50)
-        & df["latitude"].between(40.5, 41.2)
-    ].copy()
-
     return df
 
 
+def adaptive_bounds(sketches, config, min_price, max_price):
+    """
+    Bounds derived from the configured quantiles of the sketched columns. The columns that are not sketched
+    keep their fixed bounds.
+
+    :param sketches: dictionary of KLLSketch, keyed by column
+    :param config: the adaptive bounds configuration
+    :return: dictionary of [lower, upper], keyed by column
+    """
+    bounds = {c: list(b) for c, b in fixed_bounds(min_price, max_price).items()}
+    bounds.update(quantile_bounds(sketches, config["quantiles"]))
+    return bounds
+
+
+def clean_chunked(input_path, output_file, config, min_price, max_price):
+    """
+    Cleans a file that may not fit in memory with adaptive bounds, in two chunked passes: the first one
+    sketches the distribution of the configured columns, the second one filters the rows.
+
+    :return: the bounds used
+    """
+    columns = list(config["quantiles"])
+    logger.info(f"Sketching the quantiles of {columns} in {input_path}")
+    sketches = sketch_columns(
+        iter_csv(input_path, config["chunk_size"], usecols=columns), columns, k=config["sketch_k"]
+    )
+    bounds = adaptive_bounds(sketches, config, min_price, max_price)
+
+    n_rows = 0
+    for i, chunk in enumerate(iter_csv(input_path, config["chunk_size"])):
+        df = clean_frame(chunk, bounds)
+        df.to_csv(output_file, index=False, mode="w" if i == 0 else "a", header=i == 0)
+        n_rows += df.shape[0]
+    logger.info(f"Kept {n_rows} rows")
+    return bounds
+
+
+def bounds_metadata(bounds, config):
+    """
+    Artifact metadata describing how the dataset was filtered, read back by data_check
+    """
+    metadata = {"bounds": {c: [float(v) for v in b] for c, b in bounds.items()}}
+    if config["enabled"]:
+        metadata["bounds_quantiles"] = {c: list(q) for c, q in config["quantiles"].items()}
+    return metadata
+
+
+def go_incremental(args, run, input_path):
+    """
+    Cleans only the rows of the input that are new or changed since the last version of the output
+    artifact, and logs the output as a partitioned dataset with one more partition.
+    """
+    # Fetch the current state of the cleaned dataset, if any
+    try:
+        previous_path = dataset_path(run.use_artifact(f"{args.output_artifact}:latest"))
+    except wandb.errors.CommError:
+        logger.info(f"No previous version of {args.output_artifact}, starting a new partitioned dataset")
+        previous_path = None
+    if previous_path is not None and not is_partitioned(previous_path):
+        logger.info(f"Latest {args.output_artifact} is not partitioned, starting a new partitioned dataset")
+        previous_path = None
+    watermark = Watermark.load(previous_path)
+
+    source_digest = dataset_digest(input_path)
+    if source_digest in watermark.source_digests:
+        logger.info(f"Input {args.input_artifact} was already ingested, nothing to do")
+        return
+
+    output_dir = "clean_dataset"
+    if os.path.exists(output_dir):
+        shutil.rmtree(output_dir)
+    if previous_path is not None:
+        shutil.copytree(os.path.join(previous_path, PARTITIONS_DIR), os.path.join(output_dir, PARTITIONS_DIR))
+    else:
+        os.makedirs(os.path.join(output_dir, PARTITIONS_DIR))
+
+    # Clean only the delta
+    logger.info(f"Loading dataset from {input_path}")
+    raw = read_csv(input_path)
+    delta, hashes = watermark.delta(raw)
+    logger.info(f"{delta.sum()} new or changed rows out of {raw.shape[0]}")
+
+    state = {"envelope": {}, "sketches": {}}
+    if previous_path is not None and os.path.exists(os.path.join(previous_path, BOUNDS_NAME)):
+        with open(os.path.join(previous_path, BOUNDS_NAME)) as fp:
+            state = json.load(fp)
+    config = args.bounds_config
+    if config["enabled"]:
+        # The sketches of the previous versions are merged with the one of the delta, so the bounds follow the
+        # distribution of every row ingested so far
+        columns = list(config["quantiles"])
+        sketches = sketch_columns([raw[delta]], columns, k=config["sketch_k"])
+        for c in columns:
+            if c in state["sketches"]:
+                sketches[c].merge(KLLSketch.from_dict(state["sketches"][c]))
+        state["sketches"] = {c: sketch.to_dict() for c, sketch in sketches.items()}
+        bounds = adaptive_bounds(sketches, config, args.min_price, args.max_price)
+    else:
+        bounds = fixed_bounds(args.min_price, args.max_price)
+    df = clean_frame(raw[delta], bounds)
+
+    # Earlier partitions were filtered with the bounds of their time, the metadata records the envelope
+    for c, (lower, upper) in bounds.items():
+        previous = state["envelope"].get(c, [lower, upper])
+        state["envelope"][c] = [min(lower, previous[0]), max(upper, previous[1])]
+    with open(os.path.join(output_dir, BOUNDS_NAME), "w") as fp:
+        json.dump(state, fp)
+
+    partition = f"part-{len(watermark.partitions):05d}.csv"
+    logger.info(f"Saving {df.shape[0]} cleaned rows to partition {partition}")
+    df.to_csv(os.path.join(output_dir, PARTITIONS_DIR, partition), index=False)
+    watermark.advance(raw["id"][delta], hashes[delta], partition, source_digest, raw["last_review"][delta])
+    watermark.save(output_dir)
+
+    # Unchanged partitions are deduplicated by the chunked upload, so only the new partition is transferred
+    logger.info(f"Logging cleaned dataset as artifact: {args.output_artifact}")
+    log_chunked_artifact(
+        artifact_name=args.output_artifact,
+        artifact_type=args.output_type,
+        artifact_description=args.output_description,
+        path=output_dir,
+        wandb_run=run,
+        metadata={
+            "partitions": len(watermark.partitions),
+            "max_last_review": watermark.max_last_review,
+            **bounds_metadata(state["envelope"], config),
+        },
+    )
+
+
 def go(args):
     """
     Main function to execute the data cleaning process and log the artifact.
@@ -52,33 +211,49 @@ def go(args):
     logger.info("Starting W&B run for basic cleaning")
     run = wandb.init(job_type="basic_cleaning")
     run.config.update(args)
+    with open(args.bounds_config) as fp:
+        args.bounds_config = json.load(fp)
 
     # Fetch input artifact
     logger.info(f"Fetching input artifact: {args.input_artifact}")
     artifact = run.use_artifact(args.input_artifact)
     artifact_local_path = artifact.file()
 
-    # Clean data
-    df = clean_data(
-        input_path=artifact_local_path,
-        min_price=args.min_price,
-        max_price=args.max_price,
-    )
+    if args.incremental:
+        go_incremental(args, run, artifact_local_path)
+        run.finish()
+        return
 
-    # Save cleaned data to a new file
     output_file = "clean_sample1.csv"  # Updated to clean_sample1.csv
-    logger.info(f"Saving cleaned dataset to {output_file}")
-    df.to_csv(output_file, index=False)
+    if args.bounds_config["enabled"]:
+        # Streamed through in chunks, the input is never fully loaded
+        bounds = clean_chunked(
+            artifact_local_path, output_file, args.bounds_config, args.min_price, args.max_price
+        )
+    else:
+        # Clean data
+        df = clean_data(
+            input_path=artifact_local_path,
+            min_price=args.min_price,
+            max_price=args.max_price,
+        )
+        bounds = fixed_bounds(args.min_price, args.max_price)
+
+        # Save cleaned data to a new file
+        logger.info(f"Saving cleaned dataset to {output_file}")
+        df.to_csv(output_file, index=False)
 
-    # Log cleaned dataset as a new artifact
+    # Log cleaned dataset as a new artifact. Successive versions share most of their content, so the file is
+    # uploaded as deduplicated chunks
     logger.info(f"Logging cleaned dataset as artifact: {args.output_artifact}")
-    artifact = wandb.Artifact(
-        name=args.output_artifact,
-        type=args.output_type,
-        description=args.output_description,
+    log_chunked_artifact(
+        artifact_name=args.output_artifact,
+        artifact_type=args.output_type,
+        artifact_description=args.output_description,
+        path=output_file,
+        wandb_run=run,
+        metadata=bounds_metadata(bounds, args.bounds_config),
     )
-    artifact.add_file(output_file)
-    run.log_artifact(artifact)
 
     logger.info("Cleaning process completed and artifact logged successfully.")
     run.finish()
@@ -124,5 +299,19 @@ if __name__ == "__main__":
         help="Maximum price to include in the dataset",
     )
 
+    parser.add_argument(
+        "--incremental",
+        type=lambda s: str(s).lower() == "true",
+        default=False,
+        help="Clean only new or changed rows and append them as a new partition of the output artifact",
+    )
+
+    parser.add_argument(
+        "--bounds_config",
+        type=str,
+        required=True,
+        help="JSON file with the adaptive bounds configuration",
+    )
+
     args = parser.parse_args()
     go(args)
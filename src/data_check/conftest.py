@@ -1,7 +1,11 @@
 import pytest
-import pandas as pd
 import wandb
 import logging
+from wandb_utils.partitions import dataset_columns, dataset_path, read_dataset
+from wandb_utils.schema import NYC_BOUNDS
+
+# Columns the checks need, the others are not parsed
+CHECKED_COLUMNS = ["neighbourhood_group", "latitude", "longitude", "price"]
 
 # Setup logging
 logging.basicConfig(level=logging.INFO, format="%(asctime)-15s %(message)s")
@@ -18,9 +22,9 @@ def pytest_addoption(parser):
     parser.addoption("--max_price", action="store", help="Maximum acceptable price")
 
 @pytest.fixture(scope="session")
-def data(request):
+def data_artifact(request):
     """
-    Pytest fixture to fetch and load the input data artifact as a DataFrame.
+    Pytest fixture to fetch the input data artifact and return its local path and metadata.
     """
     artifact_name = request.config.option.csv
     if not artifact_name:
@@ -29,7 +33,8 @@ def data(request):
     logger.info(f"Fetching data artifact: {artifact_name}")
     try:
         run = wandb.init(project="nyc_airbnb", entity="jand769-western-governors-university", job_type="data_tests", resume=True)
-        data_path = run.use_artifact(artifact_name).file()
+        artifact = run.use_artifact(artifact_name)
+        data_path = dataset_path(artifact)
         logger.info(f"Fetched data artifact from path: {data_path}")
     except wandb.errors.CommError as e:
         logger.error(f"W&B Communication Error: {e}")
@@ -40,7 +45,21 @@ def data(request):
     finally:
         run.finish()
 
-    return pd.read_csv(data_path)
+    return data_path, artifact.metadata or {}
+
+@pytest.fixture(scope="session")
+def data(data_artifact):
+    """
+    Pytest fixture to load the checked columns of the input data artifact as a DataFrame.
+    """
+    return read_dataset(data_artifact[0], usecols=CHECKED_COLUMNS)
+
+@pytest.fixture(scope="session")
+def data_columns(data_artifact):
+    """
+    Pytest fixture to read the column names of the input data artifact.
+    """
+    return dataset_columns(data_artifact[0])
 
 @pytest.fixture(scope="session")
 def ref_data(request):
@@ -54,7 +73,7 @@ def ref_data(request):
     logger.info(f"Fetching reference artifact: {artifact_name}")
     try:
         run = wandb.init(project="nyc_airbnb", entity="jand769-western-governors-university", job_type="data_tests", resume=True)
-        data_path = run.use_artifact(artifact_name).file()
+        data_path = dataset_path(run.use_artifact(artifact_name))
         logger.info(f"Fetched reference artifact from path: {data_path}")
     except wandb.errors.CommError as e:
         logger.error(f"W&B Communication Error: {e}")
@@ -65,7 +84,7 @@ def ref_data(request):
     finally:
         run.finish()
 
-    return pd.read_csv(data_path)
+    return read_dataset(data_path, usecols=["neighbourhood_group"])
 
 @pytest.fixture(scope="session")
 def kl_threshold(request):
@@ -108,3 +127,11 @@ def max_price(request):
         return float(max_price)
     except ValueError:
         pytest.fail("The provided maximum price must be a float")
+
+@pytest.fixture(scope="session")
+def bounds(data_artifact, min_price, max_price):
+    """
+    Pytest fixture to retrieve the (lower, upper) bounds the data was cleaned with: the ones recorded in the
+    artifact metadata by basic_cleaning, or the fixed price range and New York City box for older artifacts.
+    """
+    return data_artifact[1].get("bounds") or {"price": (min_price, max_price), **NYC_BOUNDS}
@@ -1,51 +1,35 @@
 import argparse
-import pandas as pd
 import scipy.stats
 import wandb
 import logging
+from conftest import CHECKED_COLUMNS
+from wandb_utils.partitions import dataset_columns, dataset_path, read_dataset
+from wandb_utils.schema import COLUMNS, NEIGHBOURHOOD_GROUPS, NYC_BOUNDS
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-def test_column_names(data):
+def test_column_names(data_columns):
     """
     Ensure the dataset has the expected columns in the correct order.
     """
-    expected_columns = [
-        "id",
-        "name",
-        "host_id",
-        "host_name",
-        "neighbourhood_group",
-        "neighbourhood",
-        "latitude",
-        "longitude",
-        "room_type",
-        "price",
-        "minimum_nights",
-        "number_of_reviews",
-        "last_review",
-        "reviews_per_month",
-        "calculated_host_listings_count",
-        "availability_365",
-    ]
-    assert list(data.columns) == expected_columns, "Column names do not match!"
+    assert data_columns == COLUMNS, "Column names do not match!"
 
 
 def test_neighborhood_names(data):
     """
     Check that all neighborhoods in the dataset are known and valid.
     """
-    known_neighborhoods = {"Bronx", "Brooklyn", "Manhattan", "Queens", "Staten Island"}
+    known_neighborhoods = set(NEIGHBOURHOOD_GROUPS)
     assert set(data["neighbourhood_group"].unique()) == known_neighborhoods, "Unknown neighborhood names!"
 
 
-def test_proper_boundaries(data):
+def test_proper_boundaries(data, bounds):
     """
     Ensure proper longitude and latitude boundaries for New York City.
     """
-    assert data["longitude"].between(-74.25, -73.50).all(), "Longitude out of bounds!"
-    assert data["latitude"].between(40.5, 41.2).all(), "Latitude out of bounds!"
+    assert data["longitude"].between(*bounds["longitude"]).all(), "Longitude out of bounds!"
+    assert data["latitude"].between(*bounds["latitude"]).all(), "Latitude out of bounds!"
 
 
 def test_similar_neigh_distrib(data, ref_data, kl_threshold):
@@ -65,11 +49,11 @@ def test_row_count(data):
     assert 15000 < data.shape[0] < 1000000, "Row count is out of range!"
 
 
-def test_price_range(data, min_price, max_price):
+def test_price_range(data, bounds):
     """
-    Ensure that all prices are within the specified range.
+    Ensure that all prices are within the range the data was cleaned with.
     """
-    assert data["price"].between(min_price, max_price).all(), "Prices out of range!"
+    assert data["price"].between(*bounds["price"]).all(), "Prices out of range!"
 
 
 def main(args):
@@ -78,20 +62,25 @@ def main(args):
     """
     run = wandb.init(job_type="data_check")
     logger.info(f"Fetching data artifact: {args.csv}")
-    data_path = run.use_artifact(args.csv).file()
-    ref_path = run.use_artifact(args.ref).file()
+    artifact = run.use_artifact(args.csv)
+    data_path = dataset_path(artifact)
+    ref_path = dataset_path(run.use_artifact(args.ref))
 
-    data = pd.read_csv(data_path)
-    ref_data = pd.read_csv(ref_path)
+    data = read_dataset(data_path, usecols=CHECKED_COLUMNS)
+    ref_data = read_dataset(ref_path, usecols=["neighbourhood_group"])
+    bounds = (artifact.metadata or {}).get("bounds") or {
+        "price": (args.min_price, args.max_price),
+        **NYC_BOUNDS,
+    }
 
     # Run tests
     logger.info("Running tests on the dataset...")
-    test_column_names(data)
+    test_column_names(dataset_columns(data_path))
     test_neighborhood_names(data)
-    test_proper_boundaries(data)
+    test_proper_boundaries(data, bounds)
     test_similar_neigh_distrib(data, ref_data, args.kl_threshold)
     test_row_count(data)
-    test_price_range(data, args.min_price, args.max_price)
+    test_price_range(data, bounds)
     logger.info("All tests passed successfully!")
 
 
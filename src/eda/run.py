@@ -0,0 +1,296 @@
+#!/usr/bin/env python
+"""
+Non-interactive profiling of a dataset: per-column statistics, missingness, top categories, correlations
+and the price distribution per borough. The file is read in chunks and every statistic is accumulated in a
+single vectorized pass, while the statistics that need the whole column (quantiles, histograms, distinct
+counts of text columns) are computed on a reservoir sample of rows.
+"""
+import argparse
+import json
+import logging
+import os
+
+import numpy as np
+import pandas as pd
+import wandb
+from wandb_utils.schema import COLUMNS, DTYPES, iter_csv
+
+logging.basicConfig(level=logging.INFO, format="%(asctime)-15s %(message)s")
+logger = logging.getLogger()
+
+NUMERIC_COLUMNS = [c for c in COLUMNS if DTYPES.get(c) in ("float32", "Int32", "Int16")]
+# Columns whose value counts are accumulated exactly (the others get their top values from the sample)
+COUNTED_COLUMNS = ["neighbourhood_group", "neighbourhood", "room_type", "host_name"]
+QUANTILES = [0.01, 0.05, 0.25, 0.5, 0.75, 0.95, 0.99]
+
+
+class ReservoirSample:
+    """
+    Uniform sample of fixed size over a stream of DataFrame chunks (Algorithm R, vectorized per chunk)
+    """
+
+    def __init__(self, size, random_seed=42):
+        self.size = size
+        self.rng = np.random.default_rng(random_seed)
+        self.seen = 0
+        self.sample = None
+
+    def update(self, chunk):
+        if self.size == 0:
+            return
+        n_fill = 0
+        if self.sample is None or len(self.sample) < self.size:
+            n_fill = min(self.size - (0 if self.sample is None else len(self.sample)), len(chunk))
+            head = chunk.iloc[:n_fill]
+            self.sample = head.copy() if self.sample is None else pd.concat([self.sample, head], ignore_index=True)
+
+        # Row i of the stream replaces a random slot with probability size / (i + 1)
+        positions = self.seen + np.arange(n_fill, len(chunk))
+        slots = (self.rng.random(positions.shape[0]) * (positions + 1)).astype(np.int64)
+        accepted = slots < self.size
+        slots, rows = slots[accepted], np.arange(n_fill, len(chunk))[accepted]
+        if slots.shape[0]:
+            # When a slot is hit several times in the chunk, the last row wins
+            _, last = np.unique(slots[::-1], return_index=True)
+            replacing = slots.shape[0] - 1 - last
+            kept = np.ones(len(self.sample), dtype=bool)
+            kept[slots[replacing]] = False
+            # The slots are exchangeable, so the replacing rows can simply be appended
+            self.sample = pd.concat([self.sample[kept], chunk.iloc[rows[replacing]]], ignore_index=True)
+        self.seen += len(chunk)
+
+
+class Profile:
+    """
+    Single-pass accumulator of the dataset statistics
+    """
+
+    def __init__(self, sample_size, top_k=10, random_seed=42):
+        self.top_k = top_k
+        self.n_rows = 0
+        self.missing = pd.Series(0, index=COLUMNS, dtype=np.int64)
+        self.numeric = None
+        self.value_counts = {c: pd.Series(dtype=np.int64) for c in COUNTED_COLUMNS}
+        self.dates = {"min": pd.NaT, "max": pd.NaT}
+        # Sums for the Pearson correlations, over the rows where all the numeric columns are present
+        self.corr_n = 0
+        self.corr_sum = np.zeros(len(NUMERIC_COLUMNS))
+        self.corr_products = np.zeros((len(NUMERIC_COLUMNS), len(NUMERIC_COLUMNS)))
+        self.borough_price = None
+        self.reservoir = ReservoirSample(sample_size, random_seed)
+
+    def update(self, chunk):
+        self.n_rows += len(chunk)
+        self.missing += chunk[COLUMNS].isna().sum()
+
+        values = chunk[NUMERIC_COLUMNS].astype("float64")
+        stats = pd.DataFrame({
+            "count": values.count(),
+            "sum": values.sum(),
+            "sum_squares": (values ** 2).sum(),
+            "min": values.min(),
+            "max": values.max(),
+        })
+        if self.numeric is None:
+            self.numeric = stats
+        else:
+            self.numeric[["count", "sum", "sum_squares"]] += stats[["count", "sum", "sum_squares"]]
+            self.numeric["min"] = np.fmin(self.numeric["min"], stats["min"])
+            self.numeric["max"] = np.fmax(self.numeric["max"], stats["max"])
+
+        complete = values.dropna().to_numpy()
+        self.corr_n += complete.shape[0]
+        self.corr_sum += complete.sum(axis=0)
+        self.corr_products += complete.T @ complete
+
+        for column in COUNTED_COLUMNS:
+            counts = chunk[column].value_counts(sort=False)
+            self.value_counts[column] = self.value_counts[column].add(counts[counts > 0], fill_value=0)
+
+        dates = chunk["last_review"]
+        self.dates["min"] = min(filter(pd.notna, [self.dates["min"], dates.min()]), default=pd.NaT)
+        self.dates["max"] = max(filter(pd.notna, [self.dates["max"], dates.max()]), default=pd.NaT)
+
+        price = chunk["price"].astype("float64")
+        grouped = price.groupby(chunk["neighbourhood_group"], observed=True).agg(["count", "sum", "min", "max"])
+        if self.borough_price is None:
+            self.borough_price = grouped
+        else:
+            combined = pd.concat([self.borough_price, grouped]).groupby(level=0)
+            self.borough_price = combined.agg({"count": "sum", "sum": "sum", "min": "min", "max": "max"})
+
+        self.reservoir.update(chunk)
+
+    def report(self):
+        """
+        Finalize the statistics
+
+        :return: a dictionary of DataFrames and values
+        """
+        sample = self.reservoir.sample
+        numeric = self.numeric.copy()
+        numeric["mean"] = numeric["sum"] / numeric["count"]
+        numeric["std"] = np.sqrt(
+            np.maximum(numeric["sum_squares"] / numeric["count"] - numeric["mean"] ** 2, 0)
+            * numeric["count"] / (numeric["count"] - 1)
+        )
+        numeric = numeric.drop(columns=["sum", "sum_squares"])
+        if sample is not None:
+            sample_quantiles = sample[NUMERIC_COLUMNS].astype("float64").quantile(QUANTILES).T
+            sample_quantiles.columns = [f"q{int(q * 100):02d}" for q in QUANTILES]
+            numeric = numeric.join(sample_quantiles)
+
+        mean = self.corr_sum / self.corr_n
+        covariance = self.corr_products / self.corr_n - np.outer(mean, mean)
+        std = np.sqrt(np.diag(covariance))
+        correlations = pd.DataFrame(
+            covariance / np.outer(std, std), index=NUMERIC_COLUMNS, columns=NUMERIC_COLUMNS
+        )
+
+        top_values = {
+            column: counts.sort_values(ascending=False).head(self.top_k).astype(np.int64)
+            for column, counts in self.value_counts.items()
+        }
+        distinct = {column: int(counts.shape[0]) for column, counts in self.value_counts.items()}
+        if sample is not None:
+            # Name lengths and distinct ratio of the free-text column, from the sample
+            name_lengths = sample["name"].dropna().astype(str).str.len()
+            top_values["name"] = sample["name"].value_counts().head(self.top_k)
+            distinct["name (sample ratio)"] = float(sample["name"].nunique() / max(1, sample["name"].count()))
+
+        borough_price = self.borough_price.copy()
+        borough_price["mean"] = borough_price["sum"] / borough_price["count"]
+        borough_price = borough_price.drop(columns="sum")
+        if sample is not None:
+            borough_quantiles = (
+                sample["price"].astype("float64")
+                .groupby(sample["neighbourhood_group"], observed=True)
+                .quantile([0.25, 0.5, 0.75])
+                .unstack()
+            )
+            borough_quantiles.columns = ["q25", "q50", "q75"]
+            borough_price = borough_price.join(borough_quantiles)
+
+        summary = {
+            "n_rows": self.n_rows,
+            "sample_size": 0 if sample is None else len(sample),
+            "last_review_min": None if pd.isna(self.dates["min"]) else str(self.dates["min"].date()),
+            "last_review_max": None if pd.isna(self.dates["max"]) else str(self.dates["max"].date()),
+            "distinct": distinct,
+        }
+        if sample is not None:
+            summary["name_length_mean"] = float(name_lengths.mean())
+
+        return {
+            "summary": summary,
+            "missing": pd.DataFrame({"missing": self.missing, "missing_fraction": self.missing / self.n_rows}),
+            "numeric": numeric,
+            "correlations": correlations,
+            "top_values": top_values,
+            "price_by_borough": borough_price,
+        }
+
+
+def profile(path, chunk_size=1000000, sample_size=100000, top_k=10, random_seed=42):
+    """
+    Profile a dataset file in a single chunked pass
+
+    :param path: path of the CSV file
+    :param chunk_size: number of rows per chunk
+    :param sample_size: size of the reservoir sample used for quantiles and text statistics (0 to skip them)
+    :param top_k: number of top values reported per categorical column
+    :param random_seed: seed for the reservoir sample
+    :return: the report, as returned by Profile.report
+    """
+    accumulator = Profile(sample_size, top_k=top_k, random_seed=random_seed)
+    for i, chunk in enumerate(iter_csv(path, chunk_size)):
+        logger.info(f"Profiling chunk {i} ({accumulator.n_rows + len(chunk)} rows so far)")
+        accumulator.update(chunk)
+    return accumulator.report()
+
+
+def write_report(report, output_dir):
+    """
+    Write the report as a JSON file (for programmatic use) and an HTML page
+
+    :return: list of the files written
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    frames = {k: v for k, v in report.items() if isinstance(v, pd.DataFrame)}
+
+    json_path = os.path.join(output_dir, "profile.json")
+    with open(json_path, "w") as fp:
+        json.dump(
+            {
+                "summary": report["summary"],
+                **{name: json.loads(frame.to_json(orient="index")) for name, frame in frames.items()},
+                "top_values": {c: s.to_dict() for c, s in report["top_values"].items()},
+            },
+            fp,
+            indent=2,
+            default=str,
+        )
+
+    html_path = os.path.join(output_dir, "profile.html")
+    sections = [f"<h1>Dataset profile</h1><pre>{json.dumps(report['summary'], indent=2, default=str)}</pre>"]
+    for name, frame in frames.items():
+        sections.append(f"<h2>{name}</h2>{frame.to_html(float_format=lambda x: f'{x:.4g}')}")
+    for column, counts in report["top_values"].items():
+        sections.append(f"<h2>Top values: {column}</h2>{counts.to_frame('count').to_html()}")
+    with open(html_path, "w") as fp:
+        fp.write("<html><body>" + "\n".join(sections) + "</body></html>")
+
+    return [json_path, html_path]
+
+
+def go(args):
+    run = wandb.init(job_type="profile")
+    run.config.update(args)
+
+    logger.info(f"Downloading {args.input_artifact}")
+    input_path = run.use_artifact(args.input_artifact).file()
+
+    report = profile(
+        input_path,
+        chunk_size=args.chunk_size,
+        sample_size=args.sample_size,
+        top_k=args.top_k,
+        random_seed=args.random_seed,
+    )
+    logger.info(f"Profiled {report['summary']['n_rows']} rows")
+
+    artifact = wandb.Artifact(
+        args.output_artifact,
+        type="profile_report",
+        description=f"Profile of {args.input_artifact}",
+        metadata=report["summary"],
+    )
+    for path in write_report(report, "profile"):
+        artifact.add_file(path)
+    run.log_artifact(artifact)
+
+    run.summary.update({"n_rows": report["summary"]["n_rows"]})
+    run.log({
+        "numeric_profile": wandb.Table(dataframe=report["numeric"].rename_axis("column").reset_index()),
+        "price_by_borough": wandb.Table(
+            dataframe=report["price_by_borough"].rename_axis("neighbourhood_group").reset_index()
+        ),
+    })
+    run.finish()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Profile a dataset")
+
+    parser.add_argument("--input_artifact", type=str, required=True, help="Dataset to profile")
+    parser.add_argument("--output_artifact", type=str, required=True, help="Name of the report artifact")
+    parser.add_argument("--chunk_size", type=int, default=1000000, help="Rows read per chunk")
+    parser.add_argument(
+        "--sample_size", type=int, default=100000,
+        help="Size of the reservoir sample used for quantiles and text statistics (0 to skip them)"
+    )
+    parser.add_argument("--top_k", type=int, default=10, help="Top values reported per categorical column")
+    parser.add_argument("--random_seed", type=int, default=42, help="Seed for the reservoir sample")
+
+    args = parser.parse_args()
+    go(args)
@@ -0,0 +1,158 @@
+"""
+Parallel k-fold cross-validation of the inference pipeline. Each fold is preprocessed once in the parent
+process, the resulting matrices are placed in shared memory and the random forests of the different folds
+are fitted concurrently by a pool of worker processes that attach to them without copying
+"""
+import logging
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+from scipy import sparse
+from sklearn.base import clone
+from sklearn.ensemble import RandomForestRegressor
+from sklearn.metrics import mean_absolute_error, r2_score
+from sklearn.model_selection import KFold, StratifiedKFold
+
+logger = logging.getLogger(__name__)
+
+
+def resolve_n_jobs(n_jobs):
+    """
+    Translate a scikit-learn n_jobs value (None, -1, -2, ...) into a number of cores
+    """
+    n_cpus = os.cpu_count() or 1
+    if n_jobs is None:
+        return 1
+    if n_jobs < 0:
+        return max(1, n_cpus + 1 + n_jobs)
+    return min(n_jobs, n_cpus)
+
+
+def split_core_budget(n_cores, n_folds):
+    """
+    Split a budget of cores between folds fitted concurrently and the n_jobs of each forest, so that the
+    total number of busy cores never exceeds the budget
+
+    :return: (number of folds fitted concurrently, n_jobs of each forest)
+    """
+    n_parallel = max(1, min(n_folds, n_cores))
+    return n_parallel, max(1, n_cores // n_parallel)
+
+
+def _share_array(array, shms):
+    shm = shared_memory.SharedMemory(create=True, size=max(1, array.nbytes))
+    shms.append(shm)
+    np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[...] = array
+    return {"name": shm.name, "shape": array.shape, "dtype": array.dtype.str}
+
+
+def _share_matrix(X, fmt, shms):
+    """
+    Copy a matrix into shared memory and return its description. Dense matrices are stored as C-contiguous
+    float32 (the dtype the forest works with), sparse ones as their data/indices/indptr arrays
+    """
+    if sparse.issparse(X):
+        X = X.asformat(fmt).astype(np.float32)
+        return {
+            "format": fmt,
+            "shape": X.shape,
+            "arrays": {k: _share_array(getattr(X, k), shms) for k in ("data", "indices", "indptr")},
+        }
+    return {"format": "dense", "arrays": {"data": _share_array(np.ascontiguousarray(X, dtype=np.float32), shms)}}
+
+
+def _attach_array(spec, shms):
+    shm = shared_memory.SharedMemory(name=spec["name"])
+    shms.append(shm)
+    return np.ndarray(spec["shape"], dtype=np.dtype(spec["dtype"]), buffer=shm.buf)
+
+
+def _attach_matrix(spec, shms):
+    arrays = {k: _attach_array(v, shms) for k, v in spec["arrays"].items()}
+    if spec["format"] == "dense":
+        return arrays["data"]
+    matrix_class = sparse.csc_matrix if spec["format"] == "csc" else sparse.csr_matrix
+    return matrix_class((arrays["data"], arrays["indices"], arrays["indptr"]), shape=spec["shape"], copy=False)
+
+
+def _evaluate_fold(fold_spec, rf_params, shms):
+    X_train = _attach_matrix(fold_spec["X_train"], shms)
+    X_val = _attach_matrix(fold_spec["X_val"], shms)
+    y_train = _attach_array(fold_spec["y_train"], shms)
+    y_val = _attach_array(fold_spec["y_val"], shms)
+
+    random_forest = RandomForestRegressor(**rf_params).fit(X_train, y_train)
+    y_pred = random_forest.predict(X_val)
+    return {"mae": mean_absolute_error(y_val, y_pred), "r2": r2_score(y_val, y_pred)}
+
+
+def _fit_fold(fold, fold_spec, rf_params):
+    shms = []
+    try:
+        # The views on the shared buffers are released when _evaluate_fold returns, so the blocks can be closed
+        metrics = _evaluate_fold(fold_spec, rf_params, shms)
+    finally:
+        for shm in shms:
+            shm.close()
+    return fold, metrics
+
+
+def cross_validate(sk_pipe, X, y, n_folds, stratify=None, random_seed=42):
+    """
+    Estimate MAE and R2 of the pipeline with k-fold cross-validation, fitting the folds in parallel.
+    The core budget is the n_jobs of the pipeline's random forest, shared between the concurrent folds
+
+    :param sk_pipe: unfitted pipeline with a "preprocessor" and a "random_forest" step
+    :param X: features DataFrame
+    :param y: target
+    :param n_folds: number of folds
+    :param stratify: optional Series of labels to stratify the folds on
+    :param random_seed: seed for the fold assignment
+    :return: (list of per-fold metrics dictionaries, dictionary of mean metrics)
+    """
+    rf_params = sk_pipe["random_forest"].get_params()
+    n_parallel, rf_params["n_jobs"] = split_core_budget(resolve_n_jobs(rf_params["n_jobs"]), n_folds)
+    logger.info(f"Cross-validating on {n_folds} folds, {n_parallel} at a time with n_jobs={rf_params['n_jobs']}")
+
+    if stratify is not None:
+        folds = StratifiedKFold(n_splits=n_folds, shuffle=True, random_state=random_seed).split(X, stratify)
+    else:
+        folds = KFold(n_splits=n_folds, shuffle=True, random_state=random_seed).split(X)
+    y = np.asarray(y, dtype=np.float64)
+
+    shms = []
+    try:
+        fold_specs = []
+        for fold, (train_idx, val_idx) in enumerate(folds):
+            logger.info(f"Preprocessing fold {fold}")
+            preprocessor = clone(sk_pipe["preprocessor"])
+            X_train = preprocessor.fit_transform(X.iloc[train_idx], y[train_idx])
+            X_val = preprocessor.transform(X.iloc[val_idx])
+            fold_specs.append({
+                # The forest is fitted on CSC matrices and predicts on CSR ones
+                "X_train": _share_matrix(X_train, "csc", shms),
+                "X_val": _share_matrix(X_val, "csr", shms),
+                "y_train": _share_array(y[train_idx], shms),
+                "y_val": _share_array(y[val_idx], shms),
+            })
+            del X_train, X_val
+
+        fold_metrics = [None] * n_folds
+        # The workers are spawned, not forked: forking after wandb.init would copy the state of its threads
+        with ProcessPoolExecutor(max_workers=n_parallel, mp_context=multiprocessing.get_context("spawn")) as executor:
+            futures = [executor.submit(_fit_fold, fold, spec, rf_params) for fold, spec in enumerate(fold_specs)]
+            for future in futures:
+                fold, metrics = future.result()
+                logger.info(f"Fold {fold}: MAE {metrics['mae']:.3f}, R2 {metrics['r2']:.3f}")
+                fold_metrics[fold] = metrics
+    finally:
+        for shm in shms:
+            shm.close()
+            shm.unlink()
+
+    mean_metrics = {k: float(np.mean([m[k] for m in fold_metrics])) for k in ("mae", "r2")}
+    logger.info(f"Cross-validation: mean MAE {mean_metrics['mae']:.3f}, mean R2 {mean_metrics['r2']:.3f}")
+    return fold_metrics, mean_metrics
@@ -1,5 +1,11 @@
 import pandas as pd
 import numpy as np
+from joblib import Parallel, delayed
+from scipy import sparse
+from sklearn.base import BaseEstimator, TransformerMixin
+from sklearn.feature_extraction.text import HashingVectorizer
+from sklearn.neighbors import BallTree
+from sklearn.preprocessing import normalize
 
 
 def delta_date_feature(dates):
@@ -9,3 +15,166 @@ def delta_date_feature(dates):
     """
     date_sanitized = pd.DataFrame(dates).apply(pd.to_datetime)
     return date_sanitized.apply(lambda d: (d.max() -d).dt.days, axis=0).to_numpy()
+
+
+class DateDeltaFeature(BaseEstimator, TransformerMixin):
+    """
+    Given a 2d array containing dates (in any format recognized by pd.to_datetime, or as days since the epoch
+    when as_days is True, as held by the feature store), it returns the delta in days between each date and
+    the most recent date in its column of the training data. Unlike delta_date_feature, the reference date is
+    learned during fit, so the feature of a row does not depend on the other rows transformed with it
+    """
+
+    def __init__(self, as_days=False):
+        self.as_days = as_days
+
+    def _days(self, X):
+        if self.as_days:
+            return np.asarray(X, dtype=np.float64)
+        dates = pd.DataFrame(X).apply(pd.to_datetime)
+        return dates.apply(lambda d: (d - pd.Timestamp(0)).dt.days, axis=0).to_numpy(dtype=np.float64)
+
+    def fit(self, X, y=None):
+        self.reference_ = np.nanmax(self._days(X), axis=0)
+        return self
+
+    def transform(self, X):
+        return self.reference_ - self._days(X)
+
+
+class HashedTfidfVectorizer(BaseEstimator, TransformerMixin):
+    """
+    Stateless alternative to TfidfVectorizer. Documents are mapped to a fixed number of hashed n-gram columns,
+    so no vocabulary is stored and every chunk of documents can be transformed independently. When use_idf is
+    True the document frequencies are accumulated chunk by chunk during fit (a single streaming pass) and the
+    resulting IDF weights are applied at transform time, with the same smoothing as TfidfVectorizer
+    """
+
+    def __init__(self, n_features=256, ngram_range=(1, 2), stop_words="english", use_idf=True,
+                 chunk_size=10000, n_jobs=None):
+        self.n_features = n_features
+        self.ngram_range = ngram_range
+        self.stop_words = stop_words
+        self.use_idf = use_idf
+        self.chunk_size = chunk_size
+        self.n_jobs = n_jobs
+
+    def _hasher(self):
+        return HashingVectorizer(
+            n_features=self.n_features,
+            ngram_range=tuple(self.ngram_range),
+            stop_words=self.stop_words,
+            alternate_sign=False,
+            norm=None,
+        )
+
+    def _chunks(self, docs):
+        docs = np.asarray(docs, dtype=object).reshape(-1)
+        return [docs[i:i + self.chunk_size] for i in range(0, docs.shape[0], self.chunk_size)]
+
+    def fit(self, X, y=None):
+        hasher = self._hasher()
+        self.n_docs_ = 0
+        document_frequency = np.zeros(self.n_features, dtype=np.int64)
+        if self.use_idf:
+            for chunk in self._chunks(X):
+                counts = hasher.transform(chunk).tocsc()
+                # Number of documents in the chunk with a non-zero count in each column
+                document_frequency += np.diff(counts.indptr)
+                self.n_docs_ += chunk.shape[0]
+            self.idf_ = np.log((1 + self.n_docs_) / (1 + document_frequency)) + 1
+        return self
+
+    def _transform_chunk(self, chunk):
+        counts = self._hasher().transform(chunk)
+        if self.use_idf:
+            counts = counts @ sparse.diags(self.idf_)
+        return normalize(counts, norm="l2", copy=False)
+
+    def transform(self, X):
+        chunks = self._chunks(X)
+        if not chunks:
+            return sparse.csr_matrix((0, self.n_features))
+        parts = Parallel(n_jobs=self.n_jobs)(delayed(self._transform_chunk)(chunk) for chunk in chunks)
+        return sparse.vstack(parts, format="csr")
+
+
+EARTH_RADIUS_KM = 6371.0
+
+
+class SpatialNeighbourFeatures(BaseEstimator, TransformerMixin):
+    """
+    Given a 2d array of (latitude, longitude) in degrees, returns k-nearest-neighbour features computed
+    against the training listings: the median price of the k nearest listings, the number of listings
+    within radius_km, and the distance in km to each landmark. The training points are indexed in a
+    haversine BallTree during fit, so that every feature is obtained with batched tree queries instead of
+    pairwise distances. When transforming the training set itself (fit_transform) each listing is excluded
+    from its own neighbourhood, so its price does not leak into its features
+    """
+
+    def __init__(self, n_neighbors=10, radius_km=1.0, landmarks=None, batch_size=100000):
+        self.n_neighbors = n_neighbors
+        self.radius_km = radius_km
+        self.landmarks = landmarks
+        self.batch_size = batch_size
+
+    def _to_radians(self, X):
+        coords = np.asarray(X, dtype=np.float64).reshape(-1, 2)
+        # Listings without coordinates are placed at the center of the training listings
+        coords = np.where(np.isnan(coords), self.center_, coords)
+        return np.radians(coords)
+
+    def fit(self, X, y):
+        coords = np.asarray(X, dtype=np.float64).reshape(-1, 2)
+        self.center_ = np.nanmean(coords, axis=0)
+        self.tree_ = BallTree(self._to_radians(X), metric="haversine")
+        self.prices_ = np.asarray(y, dtype=np.float64)
+        return self
+
+    def _features(self, points, exclude_self, offset=0):
+        n_neighbors = min(self.n_neighbors + int(exclude_self), self.prices_.shape[0])
+        _, neighbors = self.tree_.query(points, k=n_neighbors)
+        if exclude_self:
+            # With duplicate coordinates the listing itself is not necessarily the first neighbour (nor returned
+            # at all), so it is dropped by index, and the farthest neighbour is dropped when it is not there
+            is_self = neighbors == (offset + np.arange(points.shape[0]))[:, None]
+            is_self[~is_self.any(axis=1), -1] = True
+            neighbors = neighbors[~is_self].reshape(neighbors.shape[0], -1)
+        median_price = np.median(self.prices_[neighbors], axis=1)
+
+        density = self.tree_.query_radius(points, r=self.radius_km / EARTH_RADIUS_KM, count_only=True)
+        density = density - int(exclude_self)
+
+        columns = [median_price, density]
+        for lat, lon in (self.landmarks or {}).values():
+            columns.append(haversine_km(points, np.radians([lat, lon])))
+        return np.column_stack(columns)
+
+    def _transform(self, X, exclude_self):
+        points = self._to_radians(X)
+        if points.shape[0] == 0:
+            return np.empty((0, 2 + len(self.landmarks or {})))
+        return np.vstack([
+            self._features(points[i:i + self.batch_size], exclude_self, offset=i)
+            for i in range(0, points.shape[0], self.batch_size)
+        ])
+
+    def transform(self, X):
+        return self._transform(X, exclude_self=False)
+
+    def fit_transform(self, X, y=None, **fit_params):
+        return self.fit(X, y)._transform(X, exclude_self=True)
+
+    def get_feature_names_out(self, input_features=None):
+        names = ["neighbour_median_price", "listing_density"]
+        return np.array(names + [f"distance_to_{name}" for name in (self.landmarks or {})], dtype=object)
+
+
+def haversine_km(points, target):
+    """
+    Great-circle distance in km between an array of (lat, lon) points and a single target, all in radians
+    """
+    dlat = points[:, 0] - target[0]
+    dlon = points[:, 1] - target[1]
+    a = np.sin(dlat / 2) ** 2 + np.cos(points[:, 0]) * np.cos(target[0]) * np.sin(dlon / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(a))
@@ -0,0 +1,100 @@
+"""
+Permutation importance of the input columns of the inference pipeline. Importance is measured per
+original input column (e.g. all the TF-IDF outputs count as "name"), on a subsample of the validation set,
+with the columns spread over a pool of worker processes
+"""
+import copy
+
+import numpy as np
+import pandas as pd
+from joblib import Parallel, delayed
+from scipy import sparse
+from sklearn.metrics import mean_absolute_error
+
+
+def _transform_blocks(preprocessor, X):
+    """
+    Transform X with each fitted transformer of the ColumnTransformer separately, returning the output
+    blocks in the same order the ColumnTransformer concatenates them
+    """
+    blocks = {}
+    for name, transformer, columns in preprocessor.transformers_:
+        if transformer == "drop" or name == "remainder":
+            continue
+        blocks[name] = transformer.transform(X[columns])
+    return blocks
+
+
+def _stack(blocks):
+    if any(sparse.issparse(b) for b in blocks):
+        return sparse.hstack(blocks, format="csr")
+    return np.hstack([np.asarray(b).reshape(b.shape[0], -1) for b in blocks])
+
+
+def _column_importance(sk_pipe, X, y, group, base_blocks, n_repeats, seed, forest_n_jobs):
+    """
+    Increase of the MAE when the given group of input columns is shuffled (the rows of the group are
+    permuted together), for n_repeats shuffles. Only the blocks of the transformers reading the group are
+    recomputed, and the n_repeats permuted matrices are predicted in a single batch
+    """
+    preprocessor = sk_pipe["preprocessor"]
+    random_forest = copy.copy(sk_pipe["random_forest"])
+    random_forest.n_jobs = forest_n_jobs
+    affected = {name for name, _, columns in preprocessor.transformers_ if set(group) & set(columns)}
+    rng = np.random.default_rng(seed)
+
+    permuted_matrices = []
+    for _ in range(n_repeats):
+        X_permuted = X.copy()
+        X_permuted[group] = X[group].to_numpy()[rng.permutation(X.shape[0])]
+        permuted_blocks = _transform_blocks(preprocessor, X_permuted) if affected else {}
+        blocks = [permuted_blocks[name] if name in affected else block for name, block in base_blocks.items()]
+        permuted_matrices.append(_stack(blocks))
+
+    if sparse.issparse(permuted_matrices[0]):
+        batch = sparse.vstack(permuted_matrices, format="csr")
+    else:
+        batch = np.vstack(permuted_matrices)
+    y_pred = random_forest.predict(batch).reshape(n_repeats, X.shape[0])
+    return np.array([mean_absolute_error(y, p) for p in y_pred])
+
+
+def permutation_importance(sk_pipe, X, y, columns, n_repeats=5, max_rows=5000, n_jobs=1, random_seed=42):
+    """
+    Compute the permutation importance (increase in MAE) of each input column of a fitted pipeline
+
+    :param sk_pipe: fitted pipeline with a "preprocessor" (ColumnTransformer) and a "random_forest" step
+    :param X: features DataFrame (typically the validation set)
+    :param y: target
+    :param columns: input columns to evaluate, or a dictionary of groups of columns shuffled together (e.g. the
+                    stored features of each raw column), keyed by the name they are reported under
+    :param n_repeats: number of shuffles of each column
+    :param max_rows: maximum number of rows of X used (a random subsample is drawn if X is larger)
+    :param n_jobs: number of worker processes
+    :param random_seed: seed for the subsample and the shuffles
+    :return: DataFrame indexed by column with the mean and std of the MAE increase, sorted by importance
+    """
+    groups = columns if isinstance(columns, dict) else {column: [column] for column in columns}
+    if X.shape[0] > max_rows:
+        X = X.sample(n=max_rows, random_state=random_seed)
+        y = y.loc[X.index]
+    X = X.reset_index(drop=True)
+    y = np.asarray(y, dtype=np.float64)
+
+    base_blocks = _transform_blocks(sk_pipe["preprocessor"], X)
+    baseline = mean_absolute_error(y, sk_pipe["random_forest"].predict(_stack(list(base_blocks.values()))))
+
+    # With several workers each forest predicts on a single core, to keep the total within n_jobs
+    forest_n_jobs = 1 if n_jobs > 1 else sk_pipe["random_forest"].n_jobs
+    scores = Parallel(n_jobs=n_jobs)(
+        delayed(_column_importance)(sk_pipe, X, y, group, base_blocks, n_repeats, random_seed + i, forest_n_jobs)
+        for i, group in enumerate(groups.values())
+    )
+    importance = pd.DataFrame(
+        {
+            "importance": [np.mean(s - baseline) for s in scores],
+            "std": [np.std(s - baseline) for s in scores],
+        },
+        index=pd.Index(list(groups), name="column"),
+    )
+    return importance.sort_values("importance", ascending=False)
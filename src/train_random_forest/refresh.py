@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+"""
+This script refreshes an exported Random Forest with new data: the fitted preprocessor is kept as is, and
+additional trees are grown on the latest partition of the cleaned dataset
+"""
+import argparse
+import logging
+import os
+import shutil
+
+import mlflow
+import numpy as np
+
+import wandb
+from wandb_utils.chunked_artifact import download_dir
+from wandb_utils.evaluation import SEGMENT_COLUMNS, evaluate, log_evaluation
+from wandb_utils.partitions import dataset_path, read_partition
+from wandb_utils.schema import to_plain_dtypes
+from wandb_utils.splits import use_split
+from wandb_utils.upload_queue import UploadQueue
+
+logging.basicConfig(level=logging.INFO, format="%(asctime)-15s %(message)s")
+logger = logging.getLogger()
+
+
+def add_trees(random_forest, X, y, n_new_trees, retire_oldest=False):
+    """
+    Grow n_new_trees additional trees of a fitted random forest on (already preprocessed) new data, leaving
+    the existing trees untouched. Optionally drop the same number of the oldest trees, to keep the size of
+    the forest fixed
+
+    :param random_forest: fitted RandomForestRegressor, modified in place
+    :param X: preprocessed features of the new data
+    :param y: target of the new data
+    :param n_new_trees: number of trees to add
+    :param retire_oldest: whether to remove the n_new_trees oldest trees
+    :return: number of trees retired
+    """
+    n_trees = len(random_forest.estimators_)
+    # The OOB score of the old trees cannot be computed on the new data, so it is not kept
+    random_forest.set_params(warm_start=True, oob_score=False, n_estimators=n_trees + n_new_trees)
+    for attribute in ("oob_score_", "oob_prediction_"):
+        if hasattr(random_forest, attribute):
+            delattr(random_forest, attribute)
+
+    random_forest.fit(X, y)
+    random_forest.set_params(warm_start=False)
+
+    n_retired = min(n_new_trees, n_trees) if retire_oldest else 0
+    if n_retired:
+        random_forest.estimators_ = random_forest.estimators_[n_retired:]
+        random_forest.set_params(n_estimators=len(random_forest.estimators_))
+    return n_retired
+
+
+def go(args):
+    run = wandb.init(job_type="refresh_random_forest")
+    run.config.update(args)
+    upload_queue = UploadQueue(run)
+
+    logger.info(f"Loading model {args.mlflow_model}")
+    model_artifact = run.use_artifact(args.mlflow_model)
+    sk_pipe = mlflow.sklearn.load_model(download_dir(model_artifact))
+    # Every step before the forest (the features, if the model was trained with the feature store, and the
+    # preprocessor) is kept as is
+    preprocessor, random_forest = sk_pipe[:-1], sk_pipe["random_forest"]
+
+    test_df = use_split(run, args.test_artifact).materialize(run)
+    y_test = test_df.pop("price")
+
+    # Only the listings added or changed by the latest incremental cleaning, minus those of the test set
+    new_df = read_partition(dataset_path(run.use_artifact(args.new_data)), parse_dates=False)
+    new_df = new_df[~new_df["id"].isin(test_df["id"])]
+    if new_df.shape[0] == 0:
+        raise ValueError(f"No new rows to refresh the model with in {args.new_data}")
+    y_new = new_df.pop("price")
+    logger.info(f"Refreshing on {new_df.shape[0]} new rows")
+
+    # The preprocessor does not change, so the test set is transformed only once for both forests
+    X_test = preprocessor.transform(test_df)
+    metrics_before, _ = evaluate(y_test, random_forest.predict(X_test))
+    logger.info(f"Before refresh: MAE {metrics_before['mae']}, R2 {metrics_before['r2']}")
+
+    logger.info(f"Growing {args.n_new_trees} trees")
+    n_retired = add_trees(
+        random_forest,
+        preprocessor.transform(new_df),
+        np.asarray(y_new),
+        args.n_new_trees,
+        retire_oldest=args.retire_oldest,
+    )
+    logger.info(f"Retired {n_retired} trees, the forest has {len(random_forest.estimators_)} trees")
+
+    metrics, segment_metrics = evaluate(y_test, random_forest.predict(X_test), test_df[SEGMENT_COLUMNS])
+    logger.info(f"After refresh: MAE {metrics['mae']}, R2 {metrics['r2']}")
+    log_evaluation(run, metrics, segment_metrics)
+    run.summary.update({f"before_refresh_{k}": v for k, v in metrics_before.items()})
+
+    if os.path.exists("random_forest_dir"):
+        shutil.rmtree("random_forest_dir")
+    mlflow.sklearn.save_model(
+        sk_pipe,
+        "random_forest_dir",
+        input_example=to_plain_dtypes(new_df.iloc[:5]),
+        code_paths=["feature_engineering.py"],
+    )
+
+    upload_queue.submit(
+        args.output_artifact,
+        "model_export",
+        "Random forest refreshed with new data",
+        "random_forest_dir",
+        metadata={
+            "refreshed_from": model_artifact.name,
+            "new_data": args.new_data,
+            "new_rows": int(new_df.shape[0]),
+            "new_trees": args.n_new_trees,
+            "retired_trees": n_retired,
+            "n_estimators": len(random_forest.estimators_),
+        },
+        chunked=True,
+    )
+
+    run.finish()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Refresh a Random Forest model with new data")
+
+    parser.add_argument(
+        "--mlflow_model", type=str, default="random_forest_export:prod", help="Model to refresh"
+    )
+    parser.add_argument(
+        "--new_data", type=str, required=True,
+        help="Cleaned dataset artifact, the rows of its latest partition are used to grow the new trees"
+    )
+    parser.add_argument("--test_artifact", type=str, required=True, help="Test split artifact")
+    parser.add_argument("--n_new_trees", type=int, required=True, help="Number of trees to add")
+    parser.add_argument(
+        "--retire_oldest", type=lambda s: str(s).lower() == "true", default=False,
+        help="Whether to remove as many of the oldest trees as are added"
+    )
+    parser.add_argument("--output_artifact", type=str, required=True, help="Output artifact name")
+
+    args = parser.parse_args()
+    go(args)
@@ -11,35 +11,58 @@ import matplotlib.pyplot as plt
 import mlflow
 import json
 
-import pandas as pd
 import numpy as np
 from sklearn.compose import ColumnTransformer
-from sklearn.feature_extraction.text import TfidfVectorizer
+from sklearn.feature_extraction.text import TfidfTransformer, TfidfVectorizer
 from sklearn.impute import SimpleImputer
 from sklearn.model_selection import train_test_split
 from sklearn.preprocessing import OrdinalEncoder, FunctionTransformer, OneHotEncoder
 from sklearn.ensemble import RandomForestRegressor
-from sklearn.metrics import mean_absolute_error
 from sklearn.pipeline import Pipeline, make_pipeline
 
 import wandb
+from wandb_utils.evaluation import SEGMENT_COLUMNS, evaluate, log_evaluation
+from wandb_utils.feature_store import FeatureStore, ListingFeatures
+from wandb_utils.sanitize_path import sanitize_path
+from wandb_utils.schema import to_plain_dtypes
+from wandb_utils.splits import use_split
+from wandb_utils.upload_queue import UploadQueue
+
+from cross_validation import cross_validate, resolve_n_jobs
+from feature_importance import permutation_importance
+from feature_engineering import DateDeltaFeature, HashedTfidfVectorizer, SpatialNeighbourFeatures
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)-15s %(message)s")
 logger = logging.getLogger()
 
-def delta_date_feature(dates):
+def get_text_vectorizer(text_features, max_tfidf_features, hashing_features, hashing_use_idf):
     """
-    Given a 2D array of dates, calculates the delta in days
-    between each date and the most recent date in its column.
+    Returns the vectorizer used for the "name" column: either a vocabulary-based TF-IDF ("tfidf") or a
+    fixed-width hashed n-gram representation with optional streaming IDF weights ("hashing").
     """
-    date_sanitized = pd.DataFrame(dates).apply(pd.to_datetime)
-    return date_sanitized.apply(lambda d: (d.max() - d).dt.days, axis=0).to_numpy()
+    if text_features == "tfidf":
+        return TfidfVectorizer(
+            binary=False,
+            max_features=max_tfidf_features,
+            stop_words="english"
+        )
+    if text_features == "hashing":
+        return HashedTfidfVectorizer(
+            n_features=hashing_features,
+            use_idf=hashing_use_idf,
+        )
+    raise ValueError(f"Unknown text_features option: {text_features} (expected 'tfidf' or 'hashing')")
 
 
-def get_inference_pipeline(rf_config, max_tfidf_features):
+def get_inference_pipeline(rf_config, max_tfidf_features, text_features="tfidf", hashing_features=256,
+                           hashing_use_idf=True, spatial_config=None, feature_store=False):
     """
-    Builds and returns a preprocessing + Random Forest pipeline.
+    Builds and returns a preprocessing + Random Forest pipeline. With feature_store, the pipeline starts
+    with a "features" step computing the stored ListingFeatures, and the preprocessor works on them.
     """
+    if feature_store and text_features != "hashing":
+        raise ValueError("The feature store holds hashed name features, it requires text_features=hashing")
+
     # Handle categorical features
     ordinal_categorical = ["room_type"]
     non_ordinal_categorical = ["neighbourhood_group"]
@@ -50,6 +73,13 @@ def get_inference_pipeline(rf_config, max_tfidf_features):
         SimpleImputer(strategy="most_frequent"),
         OneHotEncoder()
     )
+    if feature_store:
+        # The categories are already codes of the known values, -1 when missing or unknown
+        ordinal_categorical_preproc = "passthrough"
+        non_ordinal_categorical_preproc = make_pipeline(
+            SimpleImputer(missing_values=-1, strategy="most_frequent"),
+            OneHotEncoder(handle_unknown="ignore")
+        )
 
     zero_imputed = [
         "minimum_nights",
@@ -64,30 +94,44 @@ def get_inference_pipeline(rf_config, max_tfidf_features):
 
     date_imputer = make_pipeline(
         SimpleImputer(strategy="constant", fill_value="2010-01-01"),
-        FunctionTransformer(delta_date_feature, check_inverse=False, validate=False)
+        DateDeltaFeature()
     )
 
     reshape_to_1d = FunctionTransformer(np.reshape, kw_args={"newshape": -1})
     name_tfidf = make_pipeline(
         SimpleImputer(strategy="constant", fill_value=""),
         reshape_to_1d,
-        TfidfVectorizer(
-            binary=False,
-            max_features=max_tfidf_features,
-            stop_words="english"
-        ),
+        get_text_vectorizer(text_features, max_tfidf_features, hashing_features, hashing_use_idf),
     )
 
-    preprocessor = ColumnTransformer(
-        transformers=[
-            ("ordinal_cat", ordinal_categorical_preproc, ordinal_categorical),
-            ("non_ordinal_cat", non_ordinal_categorical_preproc, non_ordinal_categorical),
-            ("impute_zero", zero_imputer, zero_imputed),
-            ("transform_date", date_imputer, ["last_review"]),
-            ("transform_name", name_tfidf, ["name"]),
-        ],
-        remainder="drop",
-    )
+    if feature_store:
+        # The stored dates are already imputed days, and the stored name features are hashed n-gram counts
+        features = ListingFeatures(n_name_features=hashing_features)
+        date_imputer = DateDeltaFeature(as_days=True)
+        name_tfidf = TfidfTransformer(use_idf=hashing_use_idf)
+        name_columns = features.name_columns
+    else:
+        name_columns = ["name"]
+
+    transformers = [
+        ("ordinal_cat", ordinal_categorical_preproc, ordinal_categorical),
+        ("non_ordinal_cat", non_ordinal_categorical_preproc, non_ordinal_categorical),
+        ("impute_zero", zero_imputer, zero_imputed),
+        ("transform_date", date_imputer, ["last_review"]),
+    ]
+
+    # Neighbourhood features from a spatial index over the training listings
+    if spatial_config and spatial_config.get("enabled", False):
+        spatial_features = SpatialNeighbourFeatures(
+            n_neighbors=spatial_config["n_neighbors"],
+            radius_km=spatial_config["radius_km"],
+            landmarks=dict(spatial_config.get("landmarks") or {}),
+        )
+        transformers.append(("spatial", spatial_features, ["latitude", "longitude"]))
+
+    transformers.append(("transform_name", name_tfidf, name_columns))
+
+    preprocessor = ColumnTransformer(transformers=transformers, remainder="drop")
 
     processed_features = ordinal_categorical + non_ordinal_categorical + zero_imputed + ["last_review", "name"]
 
@@ -99,22 +143,23 @@ def get_inference_pipeline(rf_config, max_tfidf_features):
             ("random_forest", random_forest),
         ]
     )
+    if feature_store:
+        sk_pipe.steps.insert(0, ("features", features))
 
     return sk_pipe, processed_features
 
 
-def plot_feature_importance(pipe, feat_names):
+def plot_feature_importance(feat_imp):
     """
-    Plots feature importance.
+    Plots the permutation importance (increase in MAE) of each input column.
     """
-    feat_imp = pipe["random_forest"].feature_importances_[: len(feat_names) - 1]
-    nlp_importance = sum(pipe["random_forest"].feature_importances_[len(feat_names) - 1:])
-    feat_imp = np.append(feat_imp, nlp_importance)
-
     fig_feat_imp, sub_feat_imp = plt.subplots(figsize=(10, 10))
-    sub_feat_imp.bar(range(feat_imp.shape[0]), feat_imp, color="r", align="center")
+    sub_feat_imp.bar(
+        range(feat_imp.shape[0]), feat_imp["importance"], yerr=feat_imp["std"], color="r", align="center"
+    )
     sub_feat_imp.set_xticks(range(feat_imp.shape[0]))
-    sub_feat_imp.set_xticklabels(np.array(feat_names), rotation=90)
+    sub_feat_imp.set_xticklabels(np.array(feat_imp.index), rotation=90)
+    sub_feat_imp.set_ylabel("MAE increase when shuffled")
     fig_feat_imp.tight_layout()
     return fig_feat_imp
 
@@ -122,63 +167,150 @@ def plot_feature_importance(pipe, feat_names):
 def go(args):
     run = wandb.init(job_type="train_random_forest")
     run.config.update(args)
+    upload_queue = UploadQueue(run)
 
     with open(args.rf_config) as fp:
         rf_config = json.load(fp)
     run.config.update(rf_config)
     rf_config["random_state"] = args.random_seed
 
-    trainval_local_path = run.use_artifact(args.trainval_artifact).file()
-    X = pd.read_csv(trainval_local_path)
+    with open(args.spatial_config) as fp:
+        spatial_config = json.load(fp)
+    run.config.update({"spatial_features": spatial_config})
+
+    sk_pipe, processed_features = get_inference_pipeline(
+        rf_config,
+        args.max_tfidf_features,
+        text_features=args.text_features,
+        hashing_features=args.hashing_features,
+        hashing_use_idf=args.hashing_use_idf,
+        spatial_config=spatial_config,
+        feature_store=args.feature_store_dir != "none",
+    )
+
+    # Only the columns used by the pipeline, the target, the segments and the stratification are parsed
+    columns = processed_features + ["price"] + SEGMENT_COLUMNS
+    if args.stratify_by != "none":
+        columns.append(args.stratify_by)
+    if args.feature_store_dir != "none":
+        columns.append("id")
+    X = use_split(run, args.trainval_artifact).materialize(run, usecols=list(dict.fromkeys(columns)))
     y = X.pop("price")
 
-    X_train, X_val, y_train, y_val = train_test_split(
-        X, y, test_size=args.val_size, stratify=X[args.stratify_by], random_state=args.random_seed
+    if args.feature_store_dir != "none":
+        # The features of the listings already in the store are read from it, only new or changed listings are
+        # transformed. The rest of the pipeline (the model) is fitted on the stored features
+        store = FeatureStore(sanitize_path(args.feature_store_dir), sk_pipe["features"].fit(X))
+        run.summary["feature_store_computed"] = store.update(X)
+        features = store.lookup(X["id"])
+        model, importance_columns = sk_pipe[1:], sk_pipe["features"].column_groups()
+    else:
+        features = X
+        model, importance_columns = sk_pipe, processed_features
+
+    X_train, X_val, F_train, F_val, y_train, y_val = train_test_split(
+        X, features, y, test_size=args.val_size, stratify=X[args.stratify_by], random_state=args.random_seed
     )
 
-    sk_pipe, processed_features = get_inference_pipeline(rf_config, args.max_tfidf_features)
+    if args.cv_folds > 1:
+        # Cross-validate on the whole train/validation split, for a less noisy estimate than the holdout
+        fold_metrics, cv_metrics = cross_validate(
+            model,
+            features,
+            y,
+            args.cv_folds,
+            stratify=X[args.stratify_by] if args.stratify_by != "none" else None,
+            random_seed=args.random_seed,
+        )
+        for fold, metrics in enumerate(fold_metrics):
+            run.log({"cv_fold": fold, "cv_fold_mae": metrics["mae"], "cv_fold_r2": metrics["r2"]})
+        run.summary["cv_mae"] = cv_metrics["mae"]
+        run.summary["cv_r2"] = cv_metrics["r2"]
 
     logger.info("Fitting pipeline")
-    sk_pipe.fit(X_train, y_train)
+    model.fit(F_train, y_train)
 
     logger.info("Scoring")
-    r_squared = sk_pipe.score(X_val, y_val)
-    y_pred = sk_pipe.predict(X_val)
-    mae = mean_absolute_error(y_val, y_pred)
+    # A single prediction pass, all the metrics are computed from it
+    y_pred = model.predict(F_val)
+    metrics, segment_metrics = evaluate(y_val, y_pred, X_val[SEGMENT_COLUMNS])
+    logger.info(f"MAE: {metrics['mae']}, R2: {metrics['r2']}")
 
     if os.path.exists("random_forest_dir"):
         shutil.rmtree("random_forest_dir")
     mlflow.sklearn.save_model(
         sk_pipe,
         "random_forest_dir",
-        input_example=X_train.iloc[:5],
+        input_example=to_plain_dtypes(X_train.iloc[:5]),
+        code_paths=["feature_engineering.py"],
     )
 
-    artifact = wandb.Artifact(
+    # Upload in the background while the rest of the step runs, the queue is drained by run.finish()
+    upload_queue.submit(
         args.output_artifact,
-        type="model_export",
-        description="Trained random forest model",
+        "model_export",
+        "Trained random forest model",
+        "random_forest_dir",
         metadata=rf_config,
+        chunked=True,
     )
-    artifact.add_dir("random_forest_dir")
-    run.log_artifact(artifact)
 
-    fig_feat_imp = plot_feature_importance(sk_pipe, processed_features)
-    run.summary["r2"] = r_squared
-    run.summary["mae"] = mae
+    logger.info("Computing permutation importance")
+    feat_imp = permutation_importance(
+        model,
+        F_val,
+        y_val,
+        importance_columns,
+        n_repeats=args.importance_repeats,
+        max_rows=args.importance_max_rows,
+        n_jobs=resolve_n_jobs(rf_config.get("n_jobs")),
+        random_seed=args.random_seed,
+    )
+    fig_feat_imp = plot_feature_importance(feat_imp)
+    run.summary["permutation_importance"] = feat_imp["importance"].to_dict()
+    log_evaluation(run, metrics, segment_metrics)
     run.log({"feature_importance": wandb.Image(fig_feat_imp)})
 
+    run.finish()
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Train a Random Forest model")
 
-    parser.add_argument("--trainval_artifact", type=str, required=True, help="Input training dataset artifact")
+    parser.add_argument("--trainval_artifact", type=str, required=True, help="Input train/validation split artifact (row index)")
     parser.add_argument("--val_size", type=float, required=True, help="Validation split size")
     parser.add_argument("--random_seed", type=int, default=42, help="Random seed")
     parser.add_argument("--stratify_by", type=str, default="none", help="Column to stratify by")
     parser.add_argument("--rf_config", type=str, required=True, help="Random Forest config JSON file")
+    parser.add_argument(
+        "--spatial_config", type=str, required=True, help="Spatial neighbourhood features config JSON file"
+    )
     parser.add_argument("--max_tfidf_features", type=int, default=10, help="Max number of TFIDF features")
     parser.add_argument("--output_artifact", type=str, required=True, help="Output artifact name")
+    parser.add_argument(
+        "--cv_folds", type=int, default=0, help="Number of cross-validation folds (0 to only use the holdout)"
+    )
+    parser.add_argument(
+        "--importance_repeats", type=int, default=5, help="Number of shuffles of each column for the importance"
+    )
+    parser.add_argument(
+        "--importance_max_rows", type=int, default=5000, help="Max validation rows used for the importance"
+    )
+    parser.add_argument(
+        "--text_features", type=str, default="tfidf", choices=["tfidf", "hashing"],
+        help="Representation of the name column: vocabulary TF-IDF or hashed n-grams"
+    )
+    parser.add_argument(
+        "--hashing_features", type=int, default=256, help="Number of hashed columns when text_features=hashing"
+    )
+    parser.add_argument(
+        "--hashing_use_idf", type=lambda s: str(s).lower() == "true", default=True,
+        help="Whether to learn IDF weights for the hashed text features"
+    )
+    parser.add_argument(
+        "--feature_store_dir", type=str, default="none",
+        help="Directory of the listing feature store ('none' to compute the features in the pipeline)"
+    )
 
     args = parser.parse_args()
     go(args)
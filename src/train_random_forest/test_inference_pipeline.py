@@ -0,0 +1,52 @@
+"""
+Checks of the inference pipeline on listings with missing values, read the way the training and test splits
+are read. Run with `pytest` in this directory.
+"""
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+from wandb_utils.schema import read_csv, to_plain_dtypes
+
+from run import get_inference_pipeline
+
+SAMPLE_PATH = os.path.join(os.path.dirname(__file__), "..", "..", "components", "get_data", "data", "sample1.csv")
+RF_CONFIG = {"n_estimators": 10, "max_depth": 5, "random_state": 42, "n_jobs": 1}
+
+
+@pytest.fixture(scope="module")
+def listings(tmp_path_factory):
+    """
+    Sample listings, some of them without a name, written to a CSV and read back as a split
+    """
+    df = pd.read_csv(SAMPLE_PATH, nrows=500)
+    df.loc[df.index[:20], "name"] = np.nan
+    path = tmp_path_factory.mktemp("listings") / "listings.csv"
+    df.to_csv(path, index=False)
+
+    df = to_plain_dtypes(read_csv(str(path), parse_dates=False))
+    assert df["name"].isna().sum() == 20
+    assert df["last_review"].isna().any()
+    return df
+
+
+@pytest.mark.parametrize("text_features", ["tfidf", "hashing"])
+def test_missing_values(listings, text_features):
+    sk_pipe, processed_features = get_inference_pipeline(
+        RF_CONFIG, max_tfidf_features=30, text_features=text_features, hashing_features=64
+    )
+    sk_pipe.fit(listings[processed_features], listings["price"])
+
+    y_pred = sk_pipe.predict(listings[processed_features])
+    assert np.isfinite(y_pred).all()
+
+
+def test_missing_last_review_imputed(listings):
+    sk_pipe, processed_features = get_inference_pipeline(RF_CONFIG, max_tfidf_features=30)
+    sk_pipe.fit(listings[processed_features], listings["price"])
+
+    date_feature = sk_pipe["preprocessor"].named_transformers_["transform_date"]
+    missing = listings.loc[listings["last_review"].isna(), ["last_review"]]
+    imputed = pd.DataFrame({"last_review": ["2010-01-01"] * missing.shape[0]})
+    np.testing.assert_array_equal(date_feature.transform(missing), date_feature.transform(imputed))
@@ -0,0 +1,98 @@
+"""
+Checks of the steps run through the environment pool. conda is replaced by a script that runs the command
+in the current environment. Run with `pytest test_env_pool.py`.
+"""
+import os
+import stat
+import subprocess
+import sys
+import textwrap
+
+import pytest
+
+from env_pool import EnvPool
+from worker_pool import WorkerPool
+
+# Runs `conda run --no-capture-output -n <env> <command...>` as <command...>, and records the environment
+FAKE_CONDA = textwrap.dedent(
+    """\
+    #!/bin/sh
+    echo "$4" >> "$(dirname "$0")/environments.txt"
+    shift 4
+    exec "$@"
+    """
+)
+
+PYTEST_MLPROJECT = textwrap.dedent(
+    """\
+    name: check
+    conda_env: conda.yml
+
+    entry_points:
+      main:
+        parameters:
+          expected:
+            description: Value expected by the test
+            type: string
+
+        command: "{python} -m pytest . -q -p no:cacheprovider --expected {{expected}}"
+    """
+)
+
+CONFTEST = textwrap.dedent(
+    """\
+    def pytest_addoption(parser):
+        parser.addoption("--expected", action="store")
+    """
+)
+
+TEST_CHECK = textwrap.dedent(
+    """\
+    def test_expected(request):
+        assert request.config.option.expected == "ok"
+    """
+)
+
+
+@pytest.fixture
+def check_step(tmp_path, monkeypatch):
+    """
+    An MLproject whose command is pytest, as data_check, with a fake conda on the PATH
+    """
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    conda = bin_dir / "conda"
+    conda.write_text(FAKE_CONDA)
+    conda.chmod(conda.stat().st_mode | stat.S_IEXEC)
+    monkeypatch.setenv("PATH", f"{bin_dir}{os.pathsep}{os.environ['PATH']}")
+
+    step_dir = tmp_path / "check"
+    step_dir.mkdir()
+    (step_dir / "MLproject").write_text(PYTEST_MLPROJECT.format(python=sys.executable))
+    (step_dir / "conda.yml").write_text("name: check\ndependencies:\n  - python=3.10.0\n  - pytest=7.4.4\n")
+    (step_dir / "conftest.py").write_text(CONFTEST)
+    (step_dir / "test_check.py").write_text(TEST_CHECK)
+
+    envs = EnvPool(root=str(tmp_path), spec_patterns=["check/conda.yml"])
+    monkeypatch.setattr(envs, "resolve", lambda uri: "nyc_airbnb-check")
+    return str(step_dir), envs, bin_dir / "environments.txt"
+
+
+def test_env_pool_runs_pytest_command(check_step):
+    step_dir, envs, environments = check_step
+
+    envs.run(step_dir, "main", {"expected": "ok"})
+    assert environments.read_text().split() == ["nyc_airbnb-check"]
+
+    with pytest.raises(subprocess.CalledProcessError):
+        envs.run(step_dir, "main", {"expected": "not ok"})
+
+
+def test_worker_pool_runs_pytest_command_in_env_pool(check_step, tmp_path):
+    step_dir, envs, environments = check_step
+    pool = WorkerPool(str(tmp_path / "workers"), env_pool=envs)
+
+    # Not a python script, so it runs in the pooled environment instead of on a warm worker
+    pool.run(step_dir, "main", {"expected": "ok"})
+    assert environments.read_text().split() == ["nyc_airbnb-check"]
+    assert not os.listdir(tmp_path / "workers")
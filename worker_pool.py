@@ -0,0 +1,317 @@
+"""
+Warm worker pool for the local pipeline steps.
+
+Every step runs in its own conda environment, and a cold `mlflow.run` pays for the interpreter startup and
+the imports of pandas, scikit-learn, mlflow, wandb and matplotlib before any work happens. With the pool,
+main.py keeps one long-lived worker per step environment: the worker imports the heavy modules once, then
+forks a child for every job, so each step starts from a fresh module state with the imports already hot.
+A worker exits after a number of jobs (it is started again on the next request) or after an idle timeout.
+
+Jobs are sent over a Unix socket, together with the stdout and stderr of the client, so the output of the
+step appears in the pipeline log as with mlflow.run. Steps run in warm mode do not create an MLflow
+tracking run (the steps only use W&B for tracking).
+
+The worker side runs inside the step environment with `python worker_pool.py serve ...`, and only needs
+the standard library.
+"""
+import argparse
+import atexit
+import hashlib
+import importlib
+import json
+import logging
+import os
+import runpy
+import shlex
+import socket
+import subprocess
+import sys
+import time
+import traceback
+
+logger = logging.getLogger(__name__)
+
+# Modules imported by a worker before it accepts jobs
+PRELOAD_MODULES = [
+    "numpy",
+    "pandas",
+    "scipy.sparse",
+    "sklearn.ensemble",
+    "sklearn.pipeline",
+    "matplotlib.pyplot",
+    "mlflow.sklearn",
+    "wandb",
+]
+
+# Environment variables of main.py forwarded to the steps (the rest of the environment is the worker's own,
+# which points to the step's conda environment)
+FORWARDED_ENV_PREFIXES = ("WANDB_", "MLFLOW_")
+
+_MAX_MESSAGE_SIZE = 1 << 20
+
+
+def _run_job(job, fds):
+    """
+    Run a step script in the forked child, with the client's stdout/stderr. Never returns
+    """
+    returncode = 0
+    try:
+        os.dup2(fds[0], 1)
+        os.dup2(fds[1], 2)
+        for fd in fds:
+            os.close(fd)
+        os.chdir(job["cwd"])
+        os.environ.update(job["env"])
+        sys.argv = job["argv"]
+        sys.path.insert(0, job["cwd"])
+        runpy.run_path(job["argv"][0], run_name="__main__")
+    except SystemExit as e:
+        returncode = e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
+    except BaseException:
+        traceback.print_exc()
+        returncode = 1
+    finally:
+        # os._exit skips the atexit handlers, which the steps rely on (e.g. to finish the W&B run)
+        try:
+            atexit._run_exitfuncs()
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os._exit(returncode)
+
+
+def worker_socket(socket_dir, env_name):
+    """
+    Path of the Unix socket of the worker of an environment
+    """
+    # Unix socket paths are limited to ~100 characters, so the environment name is hashed
+    return os.path.join(socket_dir, hashlib.sha1(env_name.encode()).hexdigest()[:16] + ".sock")
+
+
+def worker_alive(socket_dir, env_name):
+    """
+    Whether a worker is running in an environment. The worker may be busy with a job: the probe only waits
+    in the listen backlog, and the worker skips it without counting it as a job
+    """
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        conn.connect(worker_socket(socket_dir, env_name))
+    except (FileNotFoundError, ConnectionRefusedError):
+        return False
+    finally:
+        conn.close()
+    return True
+
+
+def serve(socket_path, max_jobs, idle_timeout):
+    """
+    Worker main loop: preload the heavy modules, then run up to max_jobs jobs, one at a time
+
+    :param socket_path: path of the Unix socket to listen on
+    :param max_jobs: number of jobs after which the worker exits
+    :param idle_timeout: seconds without jobs after which the worker exits
+    """
+    for module in PRELOAD_MODULES:
+        try:
+            importlib.import_module(module)
+        except ImportError:
+            pass
+
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(socket_path)
+    server.listen()
+    server.settimeout(idle_timeout)
+
+    try:
+        jobs = 0
+        while jobs < max_jobs:
+            try:
+                conn, _ = server.accept()
+            except socket.timeout:
+                break
+            with conn:
+                conn.settimeout(None)
+                message, fds, _, _ = socket.recv_fds(conn, _MAX_MESSAGE_SIZE, 2)
+                # A connection closed without a job is a liveness probe (see worker_alive)
+                if not message:
+                    continue
+                jobs += 1
+                job = json.loads(message)
+
+                sys.stdout.flush()
+                sys.stderr.flush()
+                pid = os.fork()
+                if pid == 0:
+                    server.close()
+                    _run_job(job, fds)
+                for fd in fds:
+                    os.close(fd)
+                _, status = os.waitpid(pid, 0)
+                conn.sendall(json.dumps({"returncode": os.waitstatus_to_exitcode(status)}).encode())
+    finally:
+        server.close()
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+
+
+def conda_env_name(project_dir):
+    """
+    Name of the conda environment mlflow creates for a project (mlflow-<sha1 of its conda.yml>)
+    """
+    from mlflow.utils.conda import _get_conda_env_name
+
+    return _get_conda_env_name(os.path.join(project_dir, _load_mlproject(project_dir)["conda_env"]))
+
+
+def _load_mlproject(project_dir):
+    import yaml
+
+    with open(os.path.join(project_dir, "MLproject")) as fp:
+        return yaml.safe_load(fp)
+
+
+def render_command(project_dir, entry_point, parameters):
+    """
+    Render the command of an MLproject entry point, the way mlflow.run does
+
+    :return: the argv of the command
+    """
+    spec = _load_mlproject(project_dir)["entry_points"][entry_point]
+    values = {name: p.get("default") for name, p in (spec.get("parameters") or {}).items()}
+    values.update(parameters)
+    command = spec["command"].replace("\\\n", " ")
+    return shlex.split(command.format(**{k: shlex.quote(str(v)) for k, v in values.items()}))
+
+
+def step_command(project_dir, entry_point, parameters):
+    """
+    Render the command of an MLproject entry point that runs a python script
+
+    :return: the argv of the command (starting with the script), or None if it is not a `python <script>`
+             command
+    """
+    argv = render_command(project_dir, entry_point, parameters)
+    if len(argv) < 2 or argv[0] != "python" or not argv[1].endswith(".py"):
+        return None
+    return argv[1:]
+
+
+class WorkerPool:
+    """
+    Client side of the pool, used by main.py. One worker per conda environment, started on demand
+    """
+
+    def __init__(self, socket_dir, max_jobs=20, idle_timeout=3600, start_timeout=120, env_pool=None):
+        """
+        :param socket_dir: directory for the Unix sockets of the workers
+        :param max_jobs: number of jobs after which a worker is recycled
+        :param idle_timeout: seconds without jobs after which a worker exits
+        :param start_timeout: maximum seconds to wait for a new worker to be ready
+        :param env_pool: optional env_pool.EnvPool providing the step environments (by default the steps use
+                         the mlflow-<hash> environments created by mlflow.run)
+        """
+        self.env_pool = env_pool
+        self.socket_dir = socket_dir
+        self.max_jobs = max_jobs
+        self.idle_timeout = idle_timeout
+        self.start_timeout = start_timeout
+        os.makedirs(socket_dir, exist_ok=True)
+        self._existing_envs = None
+
+    def _env_exists(self, env_name):
+        if self._existing_envs is None:
+            output = subprocess.run(["conda", "env", "list", "--json"], capture_output=True, check=True).stdout
+            self._existing_envs = {os.path.basename(p) for p in json.loads(output)["envs"]}
+        return env_name in self._existing_envs
+
+    def _socket_path(self, env_name):
+        return worker_socket(self.socket_dir, env_name)
+
+    def _connect(self, socket_path):
+        conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            conn.connect(socket_path)
+        except (FileNotFoundError, ConnectionRefusedError):
+            conn.close()
+            return None
+        return conn
+
+    def _start_worker(self, env_name, socket_path):
+        logger.info(f"Starting a warm worker for {env_name}")
+        subprocess.Popen(
+            [
+                "conda", "run", "--no-capture-output", "-n", env_name,
+                "python", os.path.abspath(__file__), "serve",
+                "--socket", socket_path,
+                "--max_jobs", str(self.max_jobs),
+                "--idle_timeout", str(self.idle_timeout),
+            ],
+            stdin=subprocess.DEVNULL,
+            start_new_session=True,
+        )
+        deadline = time.monotonic() + self.start_timeout
+        while time.monotonic() < deadline:
+            conn = self._connect(socket_path)
+            if conn is not None:
+                return conn
+            time.sleep(0.1)
+        raise RuntimeError(f"Worker for {env_name} did not start within {self.start_timeout} seconds")
+
+    def run(self, uri, entry_point="main", parameters=None):
+        """
+        Run a step on the warm worker of its environment. Falls back to mlflow.run when the step cannot run
+        warm: the command is not a python script, or the conda environment does not exist yet (mlflow.run
+        creates it, the next run is warm)
+
+        :param uri: local directory of the MLflow project
+        :param entry_point: entry point of the project
+        :param parameters: dictionary of parameters of the entry point
+        """
+        parameters = parameters or {}
+        argv = step_command(uri, entry_point, parameters)
+        if argv is None and self.env_pool is not None:
+            self.env_pool.run(uri, entry_point, parameters)
+            return
+        env_name = self.env_pool.resolve(uri) if self.env_pool is not None else conda_env_name(uri)
+        # Environments of the env pool are created by resolve, mlflow ones by a first cold mlflow.run
+        if argv is None or (self.env_pool is None and not self._env_exists(env_name)):
+            import mlflow
+
+            mlflow.run(uri=uri, entry_point=entry_point, parameters=parameters)
+            self._existing_envs = None
+            return
+
+        socket_path = self._socket_path(env_name)
+        conn = self._connect(socket_path) or self._start_worker(env_name, socket_path)
+        job = {
+            "cwd": os.path.abspath(uri),
+            "argv": argv,
+            "env": {k: v for k, v in os.environ.items() if k.startswith(FORWARDED_ENV_PREFIXES)},
+        }
+        sys.stdout.flush()
+        sys.stderr.flush()
+        with conn:
+            socket.send_fds(conn, [json.dumps(job).encode()], [sys.stdout.fileno(), sys.stderr.fileno()])
+            reply = b"".join(iter(lambda: conn.recv(4096), b""))
+        if not reply:
+            raise RuntimeError(f"Worker for {env_name} exited while running {uri}")
+        returncode = json.loads(reply)["returncode"]
+        if returncode != 0:
+            raise RuntimeError(f"Step {uri} ({entry_point}) failed with exit code {returncode}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Warm worker for the pipeline steps")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    serve_parser = subparsers.add_parser("serve", help="Run a worker in the current environment")
+    serve_parser.add_argument("--socket", type=str, required=True, help="Path of the Unix socket")
+    serve_parser.add_argument("--max_jobs", type=int, default=20, help="Number of jobs before the worker exits")
+    serve_parser.add_argument(
+        "--idle_timeout", type=float, default=3600, help="Seconds without jobs before the worker exits"
+    )
+
+    args = parser.parse_args()
+    serve(args.socket, args.max_jobs, args.idle_timeout)